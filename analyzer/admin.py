@@ -1,10 +1,11 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.shortcuts import redirect
 from django.urls import path, reverse
 # https://docs.djangoproject.com/en/5.1/ref/contrib/admin/#reversing-admin-urls
 from django.utils.html import format_html
-from .models import (Account, Bank, CentrobankRate, Currency, Instrument, InstrumentData,
-                     LastPrice, Operation, Position, Split, TargetPortfolio, TargetPortfolioValues)
+from .models import (Account, Bank, CentrobankRate, Currency, IndexComposition, Instrument, InstrumentData,
+                     LastPrice, MoexSecurity, Operation, Position, Split, TargetPortfolio, TargetPortfolioValues,
+                     UnresolvedInstrument)
 
 
 @admin.register(Account)
@@ -74,6 +75,13 @@ def currency_toggle_auto_rate_preload(request, currency_pk=0):
     return redirect(url)
 
 
+@admin.register(IndexComposition)
+class IndexCompositionAdmin(admin.ModelAdmin):
+    list_display = ["index_code", "date", "ticker", "weight"]
+    list_filter = ["index_code", "date"]
+    ordering = ["-date", "index_code", "-weight"]
+
+
 @admin.register(Instrument)
 class InstrumentAdmin(admin.ModelAdmin):
     list_display = ["idType", "idValue", "instrumentData"]
@@ -109,11 +117,37 @@ class InstrumentDataAdmin(admin.ModelAdmin):
     ticker_name.short_description = "Тикер/Название"
 
 
+@admin.register(UnresolvedInstrument)
+class UnresolvedInstrumentAdmin(admin.ModelAdmin):
+    list_display = ["idType", "idValue", "reason", "created", "expires", "is_expired"]
+    list_filter = ["idType"]
+    search_fields = ["idValue"]
+    ordering = ["-created"]
+    actions = ["clear_expired"]
+
+    @admin.display(boolean=True, description="Истекла")
+    def is_expired(self, obj: UnresolvedInstrument) -> bool:
+        return obj.is_expired()
+
+    @admin.action(description="Удалить все истекшие записи")
+    def clear_expired(self, request, queryset):
+        deleted = UnresolvedInstrument.objects.clear_expired()
+        self.message_user(request, f"Удалено истекших записей: {deleted}", messages.SUCCESS)
+
+
 @admin.register(LastPrice)
 class LastPriceAdmin(admin.ModelAdmin):
     list_display = ["figi", "price", "timestamp", "updated"]
 
 
+@admin.register(MoexSecurity)
+class MoexSecurityAdmin(admin.ModelAdmin):
+    list_display = ["secid", "isin", "primary_boardid", "type", "shortname", "updated"]
+    list_filter = ["type"]
+    search_fields = ["secid", "isin", "shortname"]
+    ordering = ["secid"]
+
+
 @admin.register(Operation)
 class OperationAdmin(admin.ModelAdmin):
     list_display = ["timestamp", "account", "type", "figi"]
@@ -1,14 +1,89 @@
-from datetime import datetime
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from datetime import date, datetime
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from django.conf import settings
 from pycbrf import ExchangeRate, ExchangeRates, ExchangeRateDynamics
 
+cbrfLogger = logging.getLogger(__name__)
+cbrfLogger.setLevel(settings.CURRENCY_LOGGING_LEVEL)
+
+
+class _CbrfDiskCache():
+    """Кэш сырых XML ответов ЦБ РФ на диске поверх запросов pycbrf.
+
+    Ключ - sha256 от URL запроса, в котором уже есть адрес сервиса, дата(ы) и язык.
+    Курсы на прошедшие даты не меняются, поэтому такие записи не устаревают никогда,
+    а записи на сегодня и позже живут CBRF_CACHE_TODAY_TIMEOUT.
+    """
+
+    @classmethod
+    def _get_response(cls, url: str, **kwargs) -> requests.Response:
+        if not settings.CBRF_CACHE_DIR:
+            return super()._get_response(url, **kwargs)
+
+        path = Path(settings.CBRF_CACHE_DIR) / f"{hashlib.sha256(url.encode()).hexdigest()}.xml"
+        if path.exists() and (_is_immutable(url) or
+                              time.time() - path.stat().st_mtime < settings.CBRF_CACHE_TODAY_TIMEOUT):
+            cbrfLogger.debug(f"CBRF response for {url} found in disk cache")
+            response = requests.Response()
+            response.status_code = 200
+            response.url = url
+            response._content = path.read_bytes()
+            return response
+
+        response = super()._get_response(url, **kwargs)
+        if response.status_code == 200 and len(response.content) > 0:
+            _write_atomic(path, response.content)
+        return response
+
+
+class CachedExchangeRates(_CbrfDiskCache, ExchangeRates):
+    pass
+
+
+class CachedExchangeRateDynamics(_CbrfDiskCache, ExchangeRateDynamics):
+    pass
+
+
+def _is_immutable(url: str) -> bool:
+    """Ответ неизменен, если последняя запрошенная дата уже прошла"""
+    query = parse_qs(urlsplit(url).query)
+    # date_req - курсы на дату, date_req2 - конец периода динамики
+    requested = query.get("date_req2") or query.get("date_req")
+    if not requested:
+        # без даты ЦБ отдает курсы на сегодня
+        return False
+    return datetime.strptime(requested[0], "%d/%m/%Y").date() < date.today()
+
+
+def _write_atomic(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(content)
+        os.replace(tmp_name, path)
+    except OSError as e:
+        cbrfLogger.warning(f"Cannot write CBRF response to disk cache: {e}")
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
 
 def get_rates_for_date_from_cbrf(date: datetime, locale_en=False) -> ExchangeRates:
-    rates = ExchangeRates(date, locale_en=locale_en)
+    rates = CachedExchangeRates(date, locale_en=locale_en)
     return rates
 
 
 def get_rate_dynamics_from_cbrf(currency: str,
                                 start_date: datetime,
                                 end_date: datetime = datetime.now()) -> dict[datetime, ExchangeRate]:
-    dynamics = ExchangeRateDynamics(since=start_date, till=end_date, currency=currency)
+    dynamics = CachedExchangeRateDynamics(since=start_date, till=end_date, currency=currency)
     return dynamics.rates
@@ -0,0 +1,63 @@
+import logging
+
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+
+from . import models
+from .utils import bump_cache_version, get_cache_versions
+
+holdingsLogger = logging.getLogger(__name__)
+holdingsLogger.setLevel(settings.PORTFOLIO_LOGGING_LEVEL)
+
+
+class HoldingsAggregator():
+    """Купленные количества бумаг по счетам целевого портфеля.
+
+    Количества по всем бумагам портфеля считаются одним GROUP BY запросом по позициям
+    включенных в портфель счетов и лежат в кэше одной записью.
+    Ключ записи содержит версию, которая увеличивается, когда меняются позиции этих счетов
+    или список счетов портфеля - по ней же сбрасываются и зависящие от количеств итоги.
+    Версии видны только процессам с общим кэшем, поэтому запись еще и живет не дольше
+    TARGET_PORTFOLIO_CACHE_TIMEOUT - на случай изменений из другого процесса.
+    """
+
+    def held_quantities(self, targetPortfolioId: int) -> dict[int, int]:
+        """Возвращает количества бумаг на счетах портфеля
+
+        Args:
+            targetPortfolioId (int): pk целевого портфеля
+
+        Returns:
+            dict[int, int]: pk InstrumentData -> суммарное количество по всем счетам портфеля
+        """
+        version, = get_cache_versions(self.version_key(targetPortfolioId))
+        cache_key = f"target_holdings_{targetPortfolioId}_{version}"
+        cached_value = cache.get(cache_key)
+        if cached_value is not None:
+            return cached_value
+
+        holdingsLogger.debug(f"Aggregating holdings for target portfolio {targetPortfolioId}")
+        rows = models.Position.objects.filter(
+            account__targetportfolio__pk=targetPortfolioId
+            ).exclude(instrument=None).values_list("instrument").annotate(Sum("quantity"))
+        out = {instrument: quantity or 0 for instrument, quantity in rows}
+        cache.set(cache_key, out, settings.TARGET_PORTFOLIO_CACHE_TIMEOUT)
+        return out
+
+    def invalidate_portfolio(self, targetPortfolioId: int):
+        bump_cache_version(self.version_key(targetPortfolioId))
+
+    def invalidate_accounts(self, accountIds: Iterable[int]):
+        """Сбрасывает количества всех портфелей, в которые входят счета"""
+        portfolios = models.TargetPortfolio.objects.filter(accounts__in=list(accountIds)).values_list("pk", flat=True)
+        bump_cache_version(*[self.version_key(pk) for pk in set(portfolios)])
+
+    @staticmethod
+    def version_key(targetPortfolioId: int) -> str:
+        return f"target_holdings_version_{targetPortfolioId}"
+
+
+holdings_aggregator = HoldingsAggregator()
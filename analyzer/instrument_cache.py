@@ -0,0 +1,90 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class InstrumentIdentityMap():
+    """Ограниченный LRU-кэш инструментов в памяти процесса.
+
+    Ключ - пара (idType, idValue), значение - объект InstrumentData. Повторные поиски
+    одного и того же инструмента в процессе возвращают один и тот же объект без запроса в базу.
+    Запись живет, пока данные инструмента не устарели (updated + INSTRUMENT_TIMEOUT),
+    и сбрасывается сигналами при изменении InstrumentData/Instrument.
+    """
+
+    def __init__(self, max_size: int = settings.INSTRUMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, object]] = OrderedDict()
+        self._keys_by_pk: dict[int, set[tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, idType: str, idValue: str):
+        """Возвращает InstrumentData из кэша или None"""
+        key = (idType, idValue)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, instrument = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return instrument
+
+    def put(self, idType: str, idValue: str, instrument):
+        """Кладет InstrumentData в кэш, если данные еще не устарели"""
+        if instrument is None or instrument.pk is None:
+            return
+        expires_at = instrument.updated.timestamp() + settings.INSTRUMENT_TIMEOUT
+        if expires_at <= time.time():
+            return
+        key = (idType, idValue)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, instrument)
+            self._keys_by_pk.setdefault(instrument.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_key(self, idType: str, idValue: str):
+        with self._lock:
+            self._remove((idType, idValue))
+
+    def invalidate_instrument(self, pk: int):
+        """Сбрасывает все ключи, которые указывают на данный InstrumentData"""
+        with self._lock:
+            for key in list(self._keys_by_pk.get(pk, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_pk.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики для отладки: попадания, промахи и размер кэша"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _remove(self, key: tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        pk = entry[1].pk
+        keys = self._keys_by_pk.get(pk)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._keys_by_pk[pk]
+
+
+instrument_cache = InstrumentIdentityMap()
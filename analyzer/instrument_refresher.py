@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import models, tasks
+
+refresherLogger = logging.getLogger(__name__)
+refresherLogger.setLevel(settings.INSTRUMENT_LOGGING_LEVEL)
+
+
+class InstrumentRefresher():
+    """Фоновое обновление устаревших инструментов (stale-while-revalidate).
+
+    Вместо запроса в API прямо во время рендера страницы или импорта устаревший инструмент
+    отдается как есть, а его pk ставится в очередь. Фоновый поток собирает очередь в пачки
+    и обновляет их списочными запросами справочника.
+    """
+
+    def __init__(self,
+                 batch_size: int = settings.INSTRUMENT_REFRESH_BATCH_SIZE,
+                 batch_wait: float = settings.INSTRUMENT_REFRESH_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stale_hits = 0  # сколько раз был отдан устаревший инструмент
+        self.refreshed = 0  # сколько инструментов обновлено
+        self.failed = 0  # сколько инструментов не удалось обновить
+        self._queue: queue.Queue[int] = queue.Queue()
+        self._pending: set[int] = set()  # pk, которые уже стоят в очереди
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def enqueue(self, instrument: "models.InstrumentData"):
+        """Ставит инструмент в очередь на обновление, если его там еще нет"""
+        with self._lock:
+            self.stale_hits += 1
+            if instrument.pk in self._pending:
+                return
+            self._pending.add(instrument.pk)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="instrument-refresher", daemon=True)
+                self._thread.start()
+        self._queue.put(instrument.pk)
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики для отладки: устаревшие попадания, обновлено, ошибки и длина очереди"""
+        with self._lock:
+            return {
+                "stale_hits": self.stale_hits,
+                "refreshed": self.refreshed,
+                "failed": self.failed,
+                "queue_depth": len(self._pending),
+            }
+
+    def _run(self):
+        while True:
+            pks = [self._queue.get()]
+            # ждем немного, чтобы собрать пачку побольше
+            while len(pks) < self.batch_size:
+                try:
+                    pks.append(self._queue.get(timeout=self.batch_wait))
+                except queue.Empty:
+                    break
+            try:
+                refreshed = self._refresh(pks)
+                failed = len(pks) - refreshed
+            except Exception as e:
+                refresherLogger.error(f"Background instruments refresh failed: {e}")
+                refreshed = 0
+                failed = len(pks)
+            finally:
+                close_old_connections()
+            with self._lock:
+                self._pending.difference_update(pks)
+                self.refreshed += refreshed
+                self.failed += failed
+
+    def _refresh(self, pks: list[int]) -> int:
+        refresherLogger.info(f"Refreshing {len(pks)} outdated instruments in background")
+        uids_by_type: dict[str, list[str]] = {}
+        for instrument_type, uid in models.InstrumentData.objects.filter(pk__in=pks).values_list(
+                "instrument_type", "uid"):
+            uids_by_type.setdefault(instrument_type, []).append(uid)
+
+        refreshed = 0
+        for instrument_type, uids in uids_by_type.items():
+            refreshed += tasks.refresh_instruments(uids, instrument_type)
+        return refreshed
+
+
+instrument_refresher = InstrumentRefresher()
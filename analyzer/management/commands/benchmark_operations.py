@@ -0,0 +1,83 @@
+import time
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from analyzer import models, tasks
+
+
+class Command(BaseCommand):
+    help = ("Замеряет запись операций из API в базу на синтетических данных. "
+            "Все изменения откатываются после замера.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=50000,
+                            help="Количество синтетических операций. По умолчанию - 50000.")
+        parser.add_argument("--account", dest="accountId",
+                            help="Идентификатор счета. По умолчанию - первый счет в базе.")
+        parser.add_argument("--per-row", action="store_true",
+                            help="Также замерить прежнюю запись по одной операции (get + save).")
+
+    def handle(self, *args, **options):
+        account = models.Account.objects.filter(
+            **({"accountId": options["accountId"]} if options["accountId"] else {})).first()
+        if account is None:
+            raise CommandError("Счет не найден - сначала загрузите счета")
+        operations = self.make_operations(options["count"])
+
+        with transaction.atomic():
+            if options["per_row"]:
+                self.measure("По одной операции, новые", self.store_per_row, account.accountId, operations)
+                self.measure("По одной операции, существующие", self.store_per_row, account.accountId, operations)
+                models.Operation.objects.filter(operationId__startswith="bench-").delete()
+            self.measure("Пачками, новые", tasks.store_tinkoff_operations, account.accountId, operations)
+            self.measure("Пачками, существующие", tasks.store_tinkoff_operations, account.accountId, operations)
+            transaction.set_rollback(True)
+
+    def measure(self, title: str, func, *args):
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        # журнал connection.queries ограничен 9000 записей - считаем запросы сами
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{title}: {elapsed:.2f} с, запросов к базе: {queries}"))
+
+    @staticmethod
+    def store_per_row(accountId: str, operations):
+        """Запись операций так, как она работала до пакетной записи"""
+        for operation in operations:
+            op_out = models.operation_from_tinkoff_client(operation, accountId)
+            try:
+                models.Operation.objects.get(operationId=op_out.operationId)
+            except models.Operation.DoesNotExist:
+                op_out.save()
+
+    @staticmethod
+    def make_operations(count: int) -> list:
+        """Операции в форме ответа API. figi пустой, чтобы замер не зависел от справочника инструментов"""
+        start_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        return [SimpleNamespace(
+            id=f"bench-{i}",
+            parent_operation_id="",
+            currency="rub",
+            price=SimpleNamespace(units=100 + i % 50, nano=500000000),
+            payment=SimpleNamespace(units=-(100 + i % 50), nano=-500000000),
+            state=SimpleNamespace(name="OPERATION_STATE_EXECUTED"),
+            date=start_date + timedelta(minutes=i),
+            operation_type=SimpleNamespace(name="OPERATION_TYPE_BUY"),
+            quantity=1,
+            quantity_rest=0,
+            figi="",
+            instrument_type="share",
+        ) for i in range(count)]
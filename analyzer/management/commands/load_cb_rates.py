@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from analyzer import models, tasks
+
+
+class Command(BaseCommand):
+    help = "Загружает историю курсов ЦБ РФ за период (по умолчанию - для валют с автозагрузкой курса)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "since",
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d"),
+            help="Начало периода в формате ГГГГ-ММ-ДД",
+        )
+        parser.add_argument(
+            "--till",
+            type=lambda s: datetime.strptime(s, "%Y-%m-%d"),
+            default=None,
+            help="Конец периода в формате ГГГГ-ММ-ДД. По умолчанию - сегодня.",
+        )
+        parser.add_argument(
+            "--currency",
+            action="append",
+            dest="currencies",
+            help="Код валюты, можно указать несколько раз. По умолчанию - валюты с автозагрузкой курса.",
+        )
+
+    def handle(self, *args, **options):
+        currencies = options["currencies"]
+        if not currencies:
+            currencies = list(models.Currency.objects.filter(auto_rate_preload=True).values_list("code", flat=True))
+        currencies = [currency.upper() for currency in currencies]
+        count = tasks.load_cb_rates(currencies, options["since"], options["till"])
+        self.stdout.write(self.style.SUCCESS(f"Загружено курсов: {count}"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from analyzer import tasks
+
+
+class Command(BaseCommand):
+    help = "Загружает полный справочник инструментов Т-Банка (акции, облигации, фонды, валюты)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--type",
+            action="append",
+            dest="instrument_types",
+            choices=list(tasks.CATALOG_INSTRUMENT_TYPES.keys()),
+            help="Тип инструментов для загрузки, можно указать несколько раз. По умолчанию - все.",
+        )
+
+    def handle(self, *args, **options):
+        count = tasks.preload_instruments_catalog(options["instrument_types"])
+        self.stdout.write(self.style.SUCCESS(f"Загружено инструментов: {count}"))
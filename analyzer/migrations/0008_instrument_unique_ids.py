@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:32
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_ids(apps, schema_editor):
+    """Оставляет по одной (последней) записи на каждую пару idType/idValue"""
+    Instrument = apps.get_model("analyzer", "Instrument")
+    duplicates = (Instrument.objects.values("idType", "idValue")
+                  .annotate(count=Count("pk"), last_pk=Max("pk")).filter(count__gt=1))
+    for duplicate in duplicates:
+        Instrument.objects.filter(
+            idType=duplicate["idType"], idValue=duplicate["idValue"]
+        ).exclude(pk=duplicate["last_pk"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0007_account_bank_change'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='instrumentdata',
+            name='name',
+            field=models.CharField(max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='targetportfolio',
+            name='accounts',
+            field=models.ManyToManyField(to='analyzer.account', verbose_name='Включенные счета'),
+        ),
+        migrations.AlterField(
+            model_name='targetportfolio',
+            name='name',
+            field=models.CharField(max_length=64, verbose_name='Название'),
+        ),
+        migrations.RunPython(remove_duplicate_ids, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='instrument',
+            unique_together={('idType', 'idValue')},
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0008_instrument_unique_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnresolvedInstrument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idValue', models.CharField(max_length=40, verbose_name='Идентификатор')),
+                ('idType', models.CharField(max_length=8, verbose_name='Тип идентификатора')),
+                ('reason', models.CharField(blank=True, default='', max_length=255, verbose_name='Причина')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Впервые не найден')),
+                ('expires', models.DateTimeField(db_index=True, verbose_name='Не искать до')),
+            ],
+            options={
+                'verbose_name': 'Ненайденный инструмент',
+                'verbose_name_plural': 'Ненайденные инструменты',
+                'unique_together': {('idType', 'idValue')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0009_unresolvedinstrument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MoexSecurity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('secid', models.CharField(max_length=36, unique=True, verbose_name='Код бумаги')),
+                ('isin', models.CharField(blank=True, db_index=True, default='', max_length=12, verbose_name='ISIN')),
+                ('primary_boardid', models.CharField(blank=True, default='', max_length=12, verbose_name='Основной режим торгов')),
+                ('type', models.CharField(blank=True, default='', max_length=32, verbose_name='Тип бумаги')),
+                ('shortname', models.CharField(blank=True, default='', max_length=128, verbose_name='Краткое название')),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Бумага МосБиржи',
+                'verbose_name_plural': 'Бумаги МосБиржи',
+            },
+        ),
+    ]
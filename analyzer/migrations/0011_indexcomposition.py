@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0010_moexsecurity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexComposition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index_code', models.CharField(max_length=16, verbose_name='Индекс')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('ticker', models.CharField(max_length=12, verbose_name='Тикер')),
+                ('weight', models.DecimalField(decimal_places=7, max_digits=9, verbose_name='Вес в индексе')),
+            ],
+            options={
+                'verbose_name': 'Состав индекса',
+                'verbose_name_plural': 'Составы индексов',
+                'unique_together': {('index_code', 'date', 'ticker')},
+            },
+        ),
+    ]
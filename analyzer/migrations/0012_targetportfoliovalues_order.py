@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+ORDER_NUMBER_GAP = 1024
+
+
+def spread_order_numbers(apps, schema_editor):
+    """Раздвигает номера порядка позиций с шагом ORDER_NUMBER_GAP, сохраняя текущий порядок"""
+    TargetPortfolioValues = apps.get_model("analyzer", "TargetPortfolioValues")
+    positions = list(TargetPortfolioValues.objects.order_by("targetPortfolio", "order_number", "pk"))
+    number = 0
+    portfolio = None
+    for position in positions:
+        if position.targetPortfolio_id != portfolio:
+            portfolio = position.targetPortfolio_id
+            number = 0
+        number += ORDER_NUMBER_GAP
+        position.order_number = number
+    TargetPortfolioValues.objects.bulk_update(positions, ["order_number"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analyzer', '0011_indexcomposition'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='targetportfoliovalues',
+            index=models.Index(fields=['targetPortfolio', 'order_number'], name='analyzer_ta_targetP_66c4bf_idx'),
+        ),
+        migrations.RunPython(spread_order_numbers, migrations.RunPython.noop),
+    ]
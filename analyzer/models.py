@@ -1,8 +1,9 @@
 import logging
 
-from datetime import datetime, timezone
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from typing import Dict
+from typing import Dict, Iterable
 
 from django.conf import settings
 from django.core.cache import cache
@@ -13,6 +14,12 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from . import tasks
 from .classes import Quotation
+from .holdings import holdings_aggregator
+from .instrument_cache import instrument_cache
+from .instrument_refresher import instrument_refresher
+from .rate_index import centrobank_rate_index
+from .splits import split_adjuster
+from .tclient import is_not_found_error
 from .enums import OperationType, tax_operations_name
 
 accountLoggerLevel = settings.ACCOUNT_LOGGING_LEVEL
@@ -132,15 +139,10 @@ def account_from_tinkoff_client(account):
 
 class CentrobankRateManager(models.Manager):
     def get_rate(self, date: datetime, currency: str, **kwargs):
-        """Gets rate from DB, if not exist - get trigger API call
+        """Gets rate on date or the last published before it (weekends/holidays).
+        Rates are looked up in memory index, API is called at most once per date.
         """
-        currency = currency.upper()
-        try:
-            return self.get(date=date, currency=currency)
-        except ObjectDoesNotExist:
-            print(f"Need to get a rate for {currency} from CBRF for {date}")
-        tasks.get_cb_rate(date, currency)
-        return self.get(date=date, currency=currency)
+        return centrobank_rate_index.get_rate(date, currency)
 
 
 class CentrobankRate(models.Model):
@@ -337,34 +339,82 @@ def instrument_from_tinkoff_client(instrumentIn, instrument_type="") -> Instrume
 class InstrumentManager(models.Manager):
 
     def get_instrument(self, figi: str):
-        instrumentLogger.info(f"Find instrument {figi} in DB")
+        instrumentLogger.debug(f"Find instrument {figi} in DB")
         return self._get_instrument(figi, "figi")
 
     def get_instrument_by_isin(self, isin: str):
         # идентификация инструментов в Т-Инвестициях:
         # https://russianinvestments.github.io/investAPI/faq_identification/
-        instrumentLogger.info(f"Find instrument {isin} in DB")
+        instrumentLogger.debug(f"Find instrument {isin} in DB")
         return self._get_instrument(isin, "isin")
 
     def get_instrument_by_ticker(self, ticker: str, class_code: str):
         # идентификация инструментов в Т-Инвестициях:
         # https://russianinvestments.github.io/investAPI/faq_identification/
-        instrumentLogger.info(f"Find instrument {ticker}:{class_code} in DB")
+        instrumentLogger.debug(f"Find instrument {ticker}:{class_code} in DB")
         return self._get_instrument(ticker, "ticker", class_code)
 
     def get_instrument_by_uid(self, uid: str):
         # идентификация инструментов в Т-Инвестициях:
         # https://russianinvestments.github.io/investAPI/faq_identification/
-        instrumentLogger.info(f"Find instrument {uid} in DB")
+        instrumentLogger.debug(f"Find instrument {uid} in DB")
         return self._get_instrument(uid, "uid")
 
+    def get_instruments(self, ids: list[str], idType: str = "figi") -> "Dict[str, InstrumentData]":
+        """Ищет пачку инструментов по идентификаторам одного типа одним запросом в базу.
+        Отсутствующие или устаревшие инструменты подгружаются из API параллельно.
+
+        Args:
+            ids (list[str]): идентификаторы, для ticker - в виде "ticker:class_code"
+            idType (str, optional): тип идентификаторов (figi, isin, ticker, uid)
+
+        Returns:
+            Dict[str, InstrumentData]: найденные инструменты по идентификатору
+        """
+        ids = set(id for id in ids if id != "")
+        out = {}
+        for id in ids:
+            cached = instrument_cache.get(idType, id)
+            if cached is not None:
+                out[id] = cached
+
+        to_query = [id for id in ids if id not in out]
+        instrumentLogger.debug(f"Find {len(to_query)} instruments by {idType} in DB")
+        tmpInsts = self.filter(idType=idType, idValue__in=to_query).select_related("instrumentData")
+        for tmpInst in tmpInsts:
+            instrument_age = (datetime.now(timezone.utc) - tmpInst.instrumentData.updated).total_seconds()
+            if instrument_age < settings.INSTRUMENT_TIMEOUT:
+                out[tmpInst.idValue] = tmpInst.instrumentData
+                instrument_cache.put(idType, tmpInst.idValue, tmpInst.instrumentData)
+            elif settings.INSTRUMENT_BACKGROUND_REFRESH:
+                instrument_refresher.enqueue(tmpInst.instrumentData)
+                out[tmpInst.idValue] = tmpInst.instrumentData
+
+        missing = [id for id in ids if id not in out]
+        if len(missing) > 0:
+            unresolved = UnresolvedInstrument.objects.unresolved_ids(missing, idType)
+            if len(unresolved) > 0:
+                instrumentLogger.debug(f"{len(unresolved)} instruments by {idType} are known to be unresolvable")
+                missing = [id for id in missing if id not in unresolved]
+        if len(missing) > 0:
+            instrumentLogger.info(f"{len(missing)} instruments by {idType} not found in DB - getting from API")
+            fetched = tasks.get_instruments_from_api(missing, idType)
+            for id, instrumentData in fetched.items():
+                instrument_cache.put(idType, id, instrumentData)
+            out.update(fetched)
+        return out
+
     def _get_instrument(self, id: str, idType: str, class_code: str = ""):
-        instrumentLogger.info(f"Find instrument by {idType} - {id} in DB")
+        search_id = id
+        if class_code != "":
+            search_id += ":" + class_code
+        cached = instrument_cache.get(idType, search_id)
+        if cached is not None:
+            return cached
+
+        instrumentLogger.debug(f"Find instrument by {idType} - {id} in DB")
         try:
-            search_id = id
-            if class_code != "":
-                search_id += ":" + class_code
-            tmpInst = self.get(idValue=search_id, idType=idType)
+            tmpInst = self.select_related("instrumentData").get(idValue=search_id, idType=idType)
         except ObjectDoesNotExist:
             instrumentLogger.info(f"Instrument {id} by {idType} not found in DB - getting from API")
             tmpInst = None
@@ -376,17 +426,37 @@ class InstrumentManager(models.Manager):
             # TODO: offline mode
             instrument_age = (datetime.now(timezone.utc) - tmpInst.instrumentData.updated).total_seconds()
             if instrument_age < settings.INSTRUMENT_TIMEOUT:
+                instrument_cache.put(idType, search_id, tmpInst.instrumentData)
+                return tmpInst.instrumentData
+            if settings.INSTRUMENT_BACKGROUND_REFRESH:
+                # отдаем устаревшие данные сразу, а обновляем их в фоне
+                instrumentLogger.info(f"Instrument {id} is outdated - refreshing in background")
+                instrument_refresher.enqueue(tmpInst.instrumentData)
                 return tmpInst.instrumentData
             instrumentLogger.info(f"Instrument {id} is outdated - getting from API")
+        elif UnresolvedInstrument.is_unresolved(search_id, idType):
+            # недавно уже искали и не нашли - не дергаем API еще раз
+            instrumentLogger.info(f"Instrument {search_id} by {idType} is known to be unresolvable - skip API")
+            return None
 
-        if idType == "figi":
-            instrumentData = tasks.get_instrument_by_figi(id)
-        elif idType == "ticker":
-            instrumentData = tasks.get_instrument_by_ticker(id, class_code)
-        elif idType == "uid":
-            instrumentData = tasks.get_instrument_by_uid(id)
-        elif idType == "isin":
-            instrumentData = tasks.get_instrument_by_isin(id)
+        try:
+            if idType == "figi":
+                instrumentData = tasks.get_instrument_by_figi(id)
+            elif idType == "ticker":
+                instrumentData = tasks.get_instrument_by_ticker(id, class_code)
+            elif idType == "uid":
+                instrumentData = tasks.get_instrument_by_uid(id)
+            elif idType == "isin":
+                instrumentData = tasks.get_instrument_by_isin(id)
+        except Exception as e:
+            if tmpInst is None and is_not_found_error(e):
+                UnresolvedInstrument.remember(search_id, idType, str(e))
+            raise
+        if instrumentData is None:
+            if tmpInst is None:
+                UnresolvedInstrument.remember(search_id, idType, "Not found")
+            return None
+        instrument_cache.put(idType, search_id, instrumentData)
         return instrumentData
 
 
@@ -403,12 +473,149 @@ class Instrument(models.Model):
     get_instrument_by_isin = objects.get_instrument_by_isin
     get_instrument_by_ticker = objects.get_instrument_by_ticker
     get_instrument_by_uid = objects.get_instrument_by_uid
+    get_instruments = objects.get_instruments
 
     class Meta:
+        unique_together = ["idType", "idValue"]
         verbose_name = "Интструмент"
         verbose_name_plural = "Инструменты"
 
 
+class UnresolvedInstrumentManager(models.Manager):
+
+    def is_unresolved(self, idValue: str, idType: str) -> bool:
+        """Проверяет, что идентификатор недавно не удалось найти"""
+        return self.filter(idType=idType, idValue=idValue, expires__gt=datetime.now(timezone.utc)).exists()
+
+    def unresolved_ids(self, ids: list[str], idType: str) -> set[str]:
+        """Возвращает идентификаторы из списка, которые недавно не удалось найти"""
+        return set(self.filter(idType=idType, idValue__in=ids, expires__gt=datetime.now(timezone.utc))
+                   .values_list("idValue", flat=True))
+
+    def remember(self, idValue: str, idType: str, reason: str = ""):
+        self.remember_many({idValue: reason}, idType)
+
+    def remember_many(self, reasons: Dict[str, str], idType: str):
+        """Запоминает ненайденные идентификаторы одного типа на INSTRUMENT_NEGATIVE_TIMEOUT
+
+        Args:
+            reasons (Dict[str, str]): причина (текст ошибки) по идентификатору
+            idType (str): тип идентификаторов (figi, isin, ticker, uid)
+        """
+        if len(reasons) == 0:
+            return
+        instrumentLogger.info(f"Remember {len(reasons)} unresolvable instruments by {idType}")
+        expires = datetime.now(timezone.utc) + timedelta(seconds=settings.INSTRUMENT_NEGATIVE_TIMEOUT)
+        self.bulk_create(
+            [UnresolvedInstrument(idType=idType, idValue=idValue, reason=reason[:255], expires=expires)
+             for idValue, reason in reasons.items()],
+            update_conflicts=True,
+            unique_fields=["idType", "idValue"],
+            update_fields=["reason", "expires"],
+        )
+
+    def clear_expired(self) -> int:
+        """Удаляет истекшие записи
+
+        Returns:
+            int: количество удаленных записей
+        """
+        deleted, _ = self.filter(expires__lte=datetime.now(timezone.utc)).delete()
+        return deleted
+
+
+class UnresolvedInstrument(models.Model):
+    """Идентификаторы, которые не нашлись ни в базе, ни в API.
+    Пока запись не истекла, повторно в API за ними не ходим.
+    """
+    idValue = models.CharField(max_length=40, verbose_name="Идентификатор")
+    idType = models.CharField(max_length=8, verbose_name="Тип идентификатора")
+    reason = models.CharField(max_length=255, blank=True, default="", verbose_name="Причина")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="Впервые не найден")
+    expires = models.DateTimeField(db_index=True, verbose_name="Не искать до")
+
+    objects = UnresolvedInstrumentManager()
+    is_unresolved = objects.is_unresolved
+    remember = objects.remember
+
+    class Meta:
+        unique_together = ["idType", "idValue"]
+        verbose_name = "Ненайденный инструмент"
+        verbose_name_plural = "Ненайденные инструменты"
+
+    def __str__(self) -> str:
+        return f"{self.idType}: {self.idValue}"
+
+    def is_expired(self) -> bool:
+        return self.expires <= datetime.now(timezone.utc)
+
+
+##############################
+#       MOEX SECURITY        #
+##############################
+
+class MoexSecurityManager(models.Manager):
+
+    def resolve_isins(self, isins: list[str]) -> "Dict[str, tuple[str, str] | None]":
+        """Находит тикер и основной режим торгов МосБиржи для пачки ISIN.
+        Ищет одним запросом в локальном справочнике (обновляя его, если он устарел -
+        не чаще раза в MOEX_SECURITIES_RETRY_TIMEOUT),
+        а не найденные в нем (например, уже не торгуемые) бумаги - поштучно в ISS.
+
+        Args:
+            isins (list[str]): ISIN бумаг
+
+        Returns:
+            Dict[str, tuple[str, str] | None]: (secid, primary_boardid) по ISIN, None - если бумаги на МосБирже нет.
+                ISIN, которые не удалось проверить из-за сетевой ошибки, в ответ не попадают.
+        """
+        isins = set(isin for isin in isins if isin)
+        if len(isins) == 0:
+            return {}
+        last_update = self.aggregate(models.Max("updated"))["updated__max"]
+        if (last_update is None or
+                (datetime.now(timezone.utc) - last_update).total_seconds() > settings.MOEX_SECURITIES_TIMEOUT) and \
+                cache.add("moex_securities_refresh_attempt", True, settings.MOEX_SECURITIES_RETRY_TIMEOUT):
+            # попытка обновления запоминается в кэше: после неудачи справочник не перезапрашивается
+            # на каждый поиск, а до следующей попытки используются уже загруженные данные
+            try:
+                tasks.refresh_moex_securities()
+            except Exception as e:
+                instrumentLogger.error(f"Cannot refresh MOEX securities directory: {e}")
+
+        out = {}
+        securities = (self.filter(isin__in=isins).exclude(primary_boardid="")
+                      .order_by("secid").values_list("isin", "secid", "primary_boardid"))
+        for isin, secid, board in securities:
+            out.setdefault(isin, (secid, board))
+
+        missing = isins - out.keys()
+        if len(missing) > 0:
+            instrumentLogger.info(f"{len(missing)} ISINs not found in MOEX securities directory - searching ISS")
+            out.update(tasks.search_moex_isins(missing))
+        return out
+
+
+class MoexSecurity(models.Model):
+    """Локальный справочник торгуемых бумаг МосБиржи для поиска тикера и режима торгов по ISIN"""
+    secid = models.CharField(max_length=36, unique=True, verbose_name="Код бумаги")
+    isin = models.CharField(max_length=12, db_index=True, blank=True, default="", verbose_name="ISIN")
+    primary_boardid = models.CharField(max_length=12, blank=True, default="", verbose_name="Основной режим торгов")
+    type = models.CharField(max_length=32, blank=True, default="", verbose_name="Тип бумаги")
+    shortname = models.CharField(max_length=128, blank=True, default="", verbose_name="Краткое название")
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = MoexSecurityManager()
+    resolve_isins = objects.resolve_isins
+
+    class Meta:
+        verbose_name = "Бумага МосБиржи"
+        verbose_name_plural = "Бумаги МосБиржи"
+
+    def __str__(self) -> str:
+        return f"{self.secid} ({self.isin})"
+
+
 ##############################
 #        LAST PRICE          #
 ##############################
@@ -457,6 +664,34 @@ def get_last_price(figi: str) -> LastPrice:
 #         OPERATION          #
 ##############################
 
+class OperationManager(models.Manager):
+
+    def convert_many(self, operations: "Iterable[Operation]", field: str = "payment") -> list[Decimal]:
+        """Пересчитывает поле пачки операций в рубли по курсу ЦБ РФ на дату операции.
+        Курсы берутся из индекса курсов - по одному запросу в базу на валюту, а не на операцию.
+        Результат также сохраняется в каждой операции в атрибут `<field>_rub_cb` для шаблонов.
+
+        Args:
+            operations (Iterable[Operation]): операции
+            field (str, optional): поле суммы - payment или price
+
+        Returns:
+            list[Decimal]: суммы в рублях в порядке операций
+        """
+        operations = list(operations)
+        pairs = set((op.timestamp.date(), op.currency.upper()) for op in operations if op.currency.upper() != "RUB")
+        rates = centrobank_rate_index.get_rates(pairs)
+        out = []
+        for op in operations:
+            value = getattr(op, field)
+            currency = op.currency.upper()
+            if currency != "RUB":
+                value = value * rates[(op.timestamp.date(), currency)]
+            setattr(op, f"{field}_rub_cb", value)
+            out.append(value)
+        return out
+
+
 class Operation(models.Model):
     operationId = models.CharField(max_length=50, unique=True)
     parentOperationId = models.CharField(max_length=50, null=True, blank=True)
@@ -473,6 +708,8 @@ class Operation(models.Model):
     figi = models.CharField(max_length=16, blank=True, null=True)  # BBG00Y91R9T3
     instrument_type = models.CharField(max_length=8)
 
+    objects = OperationManager()
+
     class Meta():
         verbose_name = "Операция"
         verbose_name_plural = "Операции"
@@ -539,12 +776,24 @@ class Operation(models.Model):
         return out
 
 
-def operation_from_tinkoff_client(operation, accountId):
+def operation_from_tinkoff_client(operation, accountId,
+                                  account: Account | None = None,
+                                  instruments: "Dict[str, InstrumentData] | None" = None):
+    """Формирует операцию для базы данных
+
+    Args:
+        operation (TBank-Operation): операция из API
+        accountId (str): идентификатор счета
+        account (Account, optional): уже найденный счет, чтобы не искать его повторно
+        instruments (Dict[str, InstrumentData], optional): уже найденные инструменты по figi
+    """
     # print(operation)
+    if account is None:
+        account = Account.account_by_id(accountId)
     tmpOperation = Operation()
     tmpOperation.operationId = operation.id
     tmpOperation.parentOperationId = operation.parent_operation_id
-    tmpOperation.account = Account.account_by_id(accountId)
+    tmpOperation.account = account
     tmpOperation.currency = operation.currency
     tmpOperation.price = Quotation(operation.price).to_decimal()
     tmpOperation.payment = Quotation(operation.payment).to_decimal()
@@ -556,11 +805,29 @@ def operation_from_tinkoff_client(operation, accountId):
     tmpOperation.figi = operation.figi
     tmpOperation.instrument_type = operation.instrument_type
     if operation.figi != "":
-        tmpOperation.instrument = Instrument.get_instrument(operation.figi)
+        if instruments is None:
+            tmpOperation.instrument = Instrument.get_instrument(operation.figi)
+        else:
+            tmpOperation.instrument = instruments.get(operation.figi)
+        if tmpOperation.instrument is None:
+            # операцию не теряем - инструмент проставит backfill_missing_instruments
+            instrumentLogger.warning(f"Instrument by figi {operation.figi} not found - "
+                                     f"operation {operation.id} is stored without it")
 
     return tmpOperation
 
 
+def operations_from_tinkoff_client(operations, accountId) -> list[Operation]:
+    """Формирует пачку операций одного счета для базы данных.
+    Счет ищется один раз, а инструменты - одним запросом по всем figi пачки.
+    Операции, инструмент которых не найден, формируются без него.
+    """
+    account = Account.account_by_id(accountId)
+    instruments = Instrument.get_instruments([operation.figi for operation in operations], "figi")
+    return [operation_from_tinkoff_client(operation, accountId, account, instruments)
+            for operation in operations]
+
+
 ##############################
 #         POSITION           #
 ##############################
@@ -591,11 +858,29 @@ class Position(models.Model):
         verbose_name_plural = "Позиции"
 
 
-def position_from_tinkoff_client(position, accountId: str) -> Position:
+def position_from_tinkoff_client(position, accountId: str,
+                                 account: Account | None = None,
+                                 instruments: "Dict[str, InstrumentData] | None" = None) -> Position:
+    """Формирует позицию для базы данных
+
+    Args:
+        position (TBank-PortfolioPosition): позиция из API
+        accountId (str): идентификатор счета
+        account (Account, optional): уже найденный счет, чтобы не искать его повторно
+        instruments (Dict[str, InstrumentData], optional): уже найденные инструменты по uid
+    """
+    if account is None:
+        account = Account.account_by_id(accountId)
     tmpPosition = Position()
-    tmpPosition.account = Account.account_by_id(accountId)
+    tmpPosition.account = account
     tmpPosition.figi = position.figi
-    tmpPosition.instrument = Instrument.get_instrument_by_uid(position.instrument_uid)
+    if instruments is None:
+        tmpPosition.instrument = Instrument.get_instrument_by_uid(position.instrument_uid)
+    else:
+        tmpPosition.instrument = instruments.get(position.instrument_uid)
+    if tmpPosition.instrument is None:
+        instrumentLogger.warning(f"Instrument by uid {position.instrument_uid} not found - "
+                                 f"position is stored without it")
     tmpPosition.quantity = Quotation(position.quantity).to_integer()
     tmpPosition.blocked = position.blocked
     tmpPosition.position_uid = position.position_uid
@@ -612,7 +897,7 @@ class PortfolioPosition():
     """accounts: list[str] | None
     figi: str
     instrument: Instrument
-    history: list[Operation]
+    history: list[Operation] - с quantity_adjusted/price_adjusted с учетом сплитов
     quantity: int = 0
     lastPrice: Decimal
     marketValue: Decimal"""
@@ -623,7 +908,8 @@ class PortfolioPosition():
         self.instrument = Instrument.get_instrument(figi)
 
         tmpPositions = Position.objects.filter(instrument=self.instrument)
-        tmpHistory = Operation.objects.filter(instrument=self.instrument).order_by("-timestamp")
+        tmpHistory = Operation.objects.filter(instrument=self.instrument).order_by("-timestamp").select_related(
+            "instrument")
         if len(accounts) > 0:
             tmpPositions.filter(accountId__in=accounts)
             tmpHistory.filter(accountId__in=accounts)
@@ -632,9 +918,7 @@ class PortfolioPosition():
         for tmpPosition in tmpPositions:
             self.quantity += tmpPosition.quantity
 
-        self.history = []
-        for record in tmpHistory:
-            self.history.append(record)
+        self.history = split_adjuster.adjust_operations(tmpHistory)
 
         lp = get_last_price(figi)
         self.lastPrice = lp.price
@@ -666,6 +950,22 @@ class Split(models.Model):
         verbose_name_plural = "Сплиты"
 
 
+class IndexComposition(models.Model):
+    """Состав индекса МосБиржи на дату - веса бумаг в процентах"""
+    index_code = models.CharField(max_length=16, verbose_name="Индекс")
+    date = models.DateField(verbose_name="Дата")
+    ticker = models.CharField(max_length=12, verbose_name="Тикер")
+    weight = models.DecimalField(max_digits=9, decimal_places=7, verbose_name="Вес в индексе")
+
+    class Meta:
+        unique_together = ["index_code", "date", "ticker"]
+        verbose_name = "Состав индекса"
+        verbose_name_plural = "Составы индексов"
+
+    def __str__(self) -> str:
+        return f"{self.index_code} {self.date}: {self.ticker} - {self.weight}"
+
+
 ##############################
 #          TARGETS           #
 ##############################
@@ -700,6 +1000,83 @@ class TargetPortfolio(models.Model):
         return self.positions_count()
 
 
+class TargetPortfolioValuesManager(models.Manager):
+    # Шаг между соседними номерами порядка: позицию можно переставить между соседями,
+    # записав только ее номер, пока между ними есть свободный номер
+    ORDER_NUMBER_GAP = 1024
+
+    def next_order_number(self, targetPortfolio: "TargetPortfolio") -> int:
+        """Номер порядка для позиции, добавляемой в конец списка"""
+        max_number = self.filter(targetPortfolio=targetPortfolio).aggregate(models.Max("order_number"))
+        return (max_number["order_number__max"] or 0) + self.ORDER_NUMBER_GAP
+
+    def move(self, position: "TargetPortfolioValues", dir: str) -> bool:
+        """Переставляет позицию на одну вверх или вниз.
+        Позиция получает номер посередине между двумя соседями в нужную сторону - пишется одна строка.
+        Если свободного номера между ними нет - весь список перенумеровывается одним bulk_update.
+
+        Args:
+            position (TargetPortfolioValues): позиция
+            dir (str): направление - up/down
+
+        Returns:
+            bool: была ли позиция перемещена (False - если она уже крайняя)
+        """
+        siblings = self.filter(targetPortfolio_id=position.targetPortfolio_id)
+        if dir == "up":
+            neighbours = list(siblings.filter(order_number__lt=position.order_number)
+                              .order_by("-order_number").values_list("order_number", flat=True)[:2])
+            step = -self.ORDER_NUMBER_GAP
+        else:
+            neighbours = list(siblings.filter(order_number__gt=position.order_number)
+                              .order_by("order_number").values_list("order_number", flat=True)[:2])
+            step = self.ORDER_NUMBER_GAP
+        if len(neighbours) == 0:
+            return False
+
+        if len(neighbours) == 1:
+            new_number = neighbours[0] + step
+        else:
+            new_number = (neighbours[0] + neighbours[1]) // 2
+            if new_number in neighbours:
+                # соседи идут подряд - раздвигаем номера и пробуем еще раз
+                self.renumber(position.targetPortfolio_id)
+                position.refresh_from_db(fields=["order_number"])
+                return self.move(position, dir)
+
+        position.order_number = new_number
+        position.save(update_fields=["order_number"])
+        return True
+
+    def apply_order(self, targetPortfolioId: int, position_pks: list[int]) -> int:
+        """Сохраняет порядок позиций целиком - одним bulk_update.
+        Позиции портфеля, которых нет в списке, остаются после перечисленных в прежнем порядке.
+
+        Args:
+            targetPortfolioId (int): pk целевого портфеля
+            position_pks (list[int]): pk позиций в нужном порядке
+
+        Returns:
+            int: количество позиций, у которых поменялся номер
+        """
+        positions = {position.pk: position for position in
+                     self.filter(targetPortfolio_id=targetPortfolioId).order_by("order_number", "pk")}
+        ordered = [positions.pop(pk) for pk in dict.fromkeys(position_pks) if pk in positions]
+        ordered.extend(positions.values())
+
+        to_update = []
+        for i, position in enumerate(ordered, start=1):
+            if position.order_number != i * self.ORDER_NUMBER_GAP:
+                position.order_number = i * self.ORDER_NUMBER_GAP
+                to_update.append(position)
+        self.bulk_update(to_update, ["order_number"])
+        return len(to_update)
+
+    def renumber(self, targetPortfolioId: int) -> int:
+        """Раздвигает номера позиций портфеля с шагом ORDER_NUMBER_GAP, сохраняя порядок"""
+        return self.apply_order(targetPortfolioId, [])
+
+
 class TargetPortfolioValues(models.Model):
     """Список целевых значений и весов для данного портфеля
     """
@@ -713,8 +1090,12 @@ class TargetPortfolioValues(models.Model):
 
     # TODO: индекс по уникальности - портфель/инструмент
 
-    BOUGHT_QTTY_CACHE_TIMEOUT = 300  # Обновлять количество купленных бумаг раз в 5 минут
-    BOUGHT_PRICE_CACHE_TIMEOUT = 60  # Обновлять стоимость купленных бумаг раз в 1 минуту
+    objects = TargetPortfolioValuesManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["targetPortfolio", "order_number"]),
+        ]
 
     def corrected_weight(self):
         """Вес, скорректированный на коэффициент
@@ -776,19 +1157,8 @@ class TargetPortfolioValues(models.Model):
         Returns:
             : количество уже купленных бумаг
         """
-        cache_key = f"bought_qtty_{self.pk}"
-        cached_value = cache.get(cache_key)
-        if cached_value is not None:
-            return cached_value
-        qtty = Position.objects.filter(
-            account__in=self.targetPortfolio.accounts.all()).filter(
-                instrument=self.instrument).aggregate(models.Sum("quantity"))
-        instrumentLogger.info(qtty)
-        out = qtty['quantity__sum']
-        if out is None:
-            out = 0
-        cache.set(cache_key, out, self.BOUGHT_QTTY_CACHE_TIMEOUT)
-        return out
+        # количества по всем бумагам портфеля считаются и кэшируются разом
+        return holdings_aggregator.held_quantities(self.targetPortfolio_id).get(self.instrument_id, 0)
 
     def bought_price(self):
         """Стоимость купленных бумаг
@@ -796,16 +1166,105 @@ class TargetPortfolioValues(models.Model):
         Returns:
             : Стоимость уже купленных бумаг
         """
-        cache_key = f"bought_price_{self.pk}"
-        cached_value = cache.get(cache_key)
-        if cached_value is not None:
-            return cached_value
-        out = self.bought_qtty() * self.current_price()
-        cache.set(cache_key, out, self.BOUGHT_PRICE_CACHE_TIMEOUT)
-        return out
+        return self.bought_qtty() * self.current_price()
 
     def percent_complete(self) -> int:
         if self.to_buy_qtty() == 0:
             return 9999
         result = round(self.bought_qtty() / self.to_buy_qtty() * 100)
         return result
+
+
+@dataclass
+class TargetPositionCalc():
+    """Расчетные колонки строки целевого портфеля - см. TargetPortfolioSnapshot"""
+    my_weight: Decimal
+    index_correlation: Decimal
+    current_price: Decimal
+    to_buy_qtty: int
+    to_buy_price: Decimal
+    bought_qtty: int
+    bought_price: Decimal
+    percent_complete: int
+
+
+class TargetPortfolioSnapshot():
+    """Срез целевого портфеля со всеми расчетными колонками.
+
+    Строки, лоты, текущие цены и купленные количества загружаются один раз
+    (постоянное число запросов независимо от размера портфеля), после чего все колонки
+    считаются за один проход. Каждой строке проставляется атрибут calc (TargetPositionCalc),
+    который и читают шаблоны вместо методов TargetPortfolioValues.
+    """
+
+    def __init__(self, targetPortfolio: TargetPortfolio):
+        self.portfolio = targetPortfolio
+        self.positions: list[TargetPortfolioValues] = list(
+            TargetPortfolioValues.objects.filter(targetPortfolio=targetPortfolio)
+            .select_related("instrument").order_by("order_number"))
+        for position in self.positions:
+            # чтобы обращения к position.targetPortfolio не ходили в базу
+            position.targetPortfolio = targetPortfolio
+
+        prices = self._load_prices([position.instrument.figi for position in self.positions])
+        held = holdings_aggregator.held_quantities(targetPortfolio.pk)
+
+        self.total_weight = sum((position.corrected_weight() for position in self.positions), Decimal(0))
+        self.total_value = Decimal(0)
+        for position in self.positions:
+            position.calc = self._calculate(position, prices.get(position.instrument.figi, Decimal(0)),
+                                            held.get(position.instrument_id) or 0)
+            self.total_value += position.calc.bought_price
+
+    def position(self, position_pk: int) -> TargetPortfolioValues | None:
+        for position in self.positions:
+            if position.pk == position_pk:
+                return position
+        return None
+
+    def _calculate(self, position: TargetPortfolioValues, price: Decimal, bought_qtty: int) -> TargetPositionCalc:
+        my_weight = Decimal(0)
+        if self.total_weight != 0:
+            my_weight = Decimal(round(position.corrected_weight() / self.total_weight * 100, 2))
+        index_correlation = Decimal(0)
+        if position.indexTarget != 0:
+            index_correlation = my_weight / position.indexTarget
+
+        to_buy_qtty = 0
+        if price != 0:
+            lots = position.instrument.lot
+            qtty = self.portfolio.targetPrice * my_weight / 100 / price
+            to_buy_qtty = round(qtty/lots)*lots
+
+        percent_complete = 9999
+        if to_buy_qtty != 0:
+            percent_complete = round(bought_qtty / to_buy_qtty * 100)
+
+        return TargetPositionCalc(
+            my_weight=my_weight,
+            index_correlation=index_correlation,
+            current_price=price,
+            to_buy_qtty=to_buy_qtty,
+            to_buy_price=to_buy_qtty * price,
+            bought_qtty=bought_qtty,
+            bought_price=bought_qtty * price,
+            percent_complete=percent_complete,
+        )
+
+    @staticmethod
+    def _load_prices(figis: list[str]) -> Dict[str, Decimal]:
+        """Текущие цены одним запросом в базу, устаревшие и отсутствующие - одним запросом в API"""
+        prices = {}
+        fresh_since = datetime.now(timezone.utc) - timedelta(seconds=settings.LAST_PRICE_TIMEOUT)
+        stale = set(figis)
+        for figi, price, updated in LastPrice.objects.filter(figi__in=figis).values_list("figi", "price", "updated"):
+            prices[figi] = price
+            if updated >= fresh_since:
+                stale.discard(figi)
+        if len(stale) > 0:
+            try:
+                tasks.get_lastprice_from_api(list(stale))
+                prices.update(LastPrice.objects.filter(figi__in=stale).values_list("figi", "price"))
+            except Exception as e:
+                instrumentLogger.error(f"Cannot update last prices for target portfolio: {e}")
+        return prices
@@ -1,8 +1,15 @@
 import logging
+import threading
+import time
 import requests
 
-from typing import List, Dict
-from datetime import datetime
+from collections import OrderedDict
+from typing import Dict, Iterator, List
+from datetime import date, datetime
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -10,8 +17,168 @@ logger.setLevel(logging.INFO)
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+ISS_URL = "https://iss.moex.com/iss/"
+
+
+class MoexIssClient():
+    """Клиент ISS МосБиржи.
+
+    Все запросы идут через одну requests.Session с пулом соединений, таймаутами
+    и повторами с нарастающей паузой. Ответы запоминаются вместе с ETag/Last-Modified,
+    и при повторном запросе того же адреса отправляется условный запрос - на 304
+    возвращается сохраненный ответ. По каждому адресу ведется статистика времени ответа.
+    """
+
+    def __init__(self, cache_size: int = settings.MOEX_CACHE_SIZE):
+        self.session = requests.Session()
+        self.session.verify = False
+        retry = Retry(total=settings.MOEX_RETRIES, backoff_factor=settings.MOEX_RETRY_BACKOFF,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
+        self.timeout = (settings.MOEX_CONNECT_TIMEOUT, settings.MOEX_READ_TIMEOUT)
+        self.cache_size = cache_size
+        # url -> (ETag, Last-Modified, разобранный ответ)
+        self._cache: OrderedDict[str, tuple[str | None, str | None, object]] = OrderedDict()
+        self._metrics: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def get_json(self, path: str, params: dict | None = None):
+        """Запрашивает адрес ISS в формате extended json без метаданных
+
+        Args:
+            path (str): путь относительно /iss/, например "statistics/engines/stock/splits.json"
+            params (dict, optional): параметры запроса
+
+        Raises:
+            requests.RequestException: при сетевой ошибке или ошибочном статусе после всех повторов
+
+        Returns:
+            list: разобранный ответ ISS
+        """
+        query = {"iss.json": "extended", "iss.meta": "off"}
+        query.update(params or {})
+        request = requests.Request("GET", ISS_URL + path, params=query).prepare()
+        url = request.url
+
+        headers = {}
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached is not None:
+            etag, last_modified, _ = cached
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        logger.debug(url)
+        started = time.monotonic()
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                self._record(path, started, not_modified=True)
+                with self._lock:
+                    self._cache.move_to_end(url)
+                return cached[2]
+            response.raise_for_status()
+            data = response.json()
+        except Exception:
+            self._record(path, started, error=True)
+            raise
+        self._record(path, started)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is not None or last_modified is not None:
+            with self._lock:
+                self._cache[url] = (etag, last_modified, data)
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return data
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Статистика по адресам: количество запросов, ошибок, 304 ответов и время ответа"""
+        with self._lock:
+            out = {}
+            for path, metric in self._metrics.items():
+                out[path] = dict(metric)
+                out[path]["avg_time"] = metric["total_time"] / metric["requests"]
+            return out
+
+    def _record(self, path: str, started: float, error: bool = False, not_modified: bool = False):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            metric = self._metrics.setdefault(
+                path, {"requests": 0, "errors": 0, "not_modified": 0, "total_time": 0.0, "max_time": 0.0})
+            metric["requests"] += 1
+            metric["errors"] += int(error)
+            metric["not_modified"] += int(not_modified)
+            metric["total_time"] += elapsed
+            metric["max_time"] = max(metric["max_time"], elapsed)
+        logger.debug(f"ISS {path} - {elapsed:.3f}s")
+
+
+iss_client = MoexIssClient()
+
+
+class IssCursorReader():
+    """Постраничное чтение блока ISS с выдачей строк генератором.
+
+    Страницы запрашиваются по параметру start, пока не кончатся данные: если в ответе
+    есть блок "<block>.cursor" (INDEX, TOTAL, PAGESIZE) - по нему, иначе до пустой или
+    неполной (короче limit) страницы, либо до страницы, повторяющей предыдущую - на случай,
+    если ISS игнорирует start. Больше max_pages страниц не читается - это ошибка.
+    В памяти держится только текущая страница. Последний курсор доступен в self.cursor.
+
+        for row in IssCursorReader("statistics/engines/stock/splits.json", "splits"):
+            ...
+    """
 
-def get_index_positions(index_code: str, date: datetime = datetime.now(), secondary=False) -> List[Dict]:
+    MAX_PAGES = 1000  # защита от бесконечного чтения, если ISS отдает одну и ту же страницу
+
+    def __init__(self, path: str, block: str, params: dict | None = None, client: MoexIssClient = iss_client,
+                 max_pages: int = MAX_PAGES):
+        self.path = path
+        self.block = block
+        self.params = params or {}
+        self.client = client
+        self.max_pages = max_pages
+        self.cursor: Dict | None = None
+        self.pages = 0
+
+    def __iter__(self) -> Iterator[Dict]:
+        start = 0
+        limit = self.params.get("limit")
+        previous_first = None
+        while True:
+            if self.pages >= self.max_pages:
+                raise Exception(f"ISS {self.path}: more than {self.max_pages} pages of {self.block} - stopping")
+            data = self.client.get_json(self.path, {**self.params, "start": start})
+            self.pages += 1
+            rows = data[1][self.block]
+            cursor = data[1].get(f"{self.block}.cursor")
+            if not cursor and len(rows) > 0 and rows[0] == previous_first:
+                # ISS проигнорировал start и вернул ту же страницу - дальше данных нет
+                logger.warning(f"ISS {self.path} ignores paging - page {self.pages} repeats the previous one")
+                return
+            yield from rows
+
+            if cursor:
+                self.cursor = cursor[0]
+                if "TOTAL" not in self.cursor:
+                    # курсор без счетчиков (например, только даты) - данные отдаются одной страницей
+                    return
+                start = self.cursor["INDEX"] + self.cursor["PAGESIZE"]
+                if start >= self.cursor["TOTAL"]:
+                    return
+            else:
+                if len(rows) == 0 or (limit is not None and len(rows) < int(limit)):
+                    return
+                previous_first = rows[0]
+                start += len(rows)
+
+
+def get_index_positions(index_code: str, date: datetime | None = None, secondary=False) -> List[Dict]:
     """Запрашивает состав индекса с сайта МосБиржи на указанную дату
 
     Args:
@@ -23,33 +190,29 @@ def get_index_positions(index_code: str, date: datetime = datetime.now(), second
         List[Dict]: Состав индекса с долями в долях процентов
     """
 
-    url = "https://iss.moex.com/iss/statistics/engines/stock/markets/index/analytics/"
-    url += index_code
-    url += ".json?limit=300"  # Переключаем в json и чтобы все прогрузилось
-    url += "&iss.json=extended&iss.meta=off"  # переводим в словарь из массива и отключаем метаданные
-    url += date.strftime("&date=%Y-%m-%d")
-
-    logger.debug(url)
-
+    if date is None:
+        # значение по умолчанию в сигнатуре вычислилось бы один раз - при импорте модуля
+        date = datetime.now()
+    path = f"statistics/engines/stock/markets/index/analytics/{index_code}.json"
+    reader = IssCursorReader(path, "analytics", {"date": date.strftime("%Y-%m-%d")})
     try:
-        response = requests.get(url, verify=False)
-        data = response.json()
+        positions = list(reader)
     except Exception as e:
         logger.error(f"Error during MOEX-index-positions request: {e}")
         return []
 
-    logger.debug(data)
+    logger.debug(positions)
 
     try:
-        if len(data[1]["analytics"]) > 0:
-            return data[1]["analytics"]
+        if len(positions) > 0:
+            return positions
 
         if secondary:
             # Если это повторный запрос, а данных так и нет - то что-то странное творится
             raise Exception("Secondary request failed")
 
         # Если запрос вернулся пустой, но есть предыдущая дата - вернуть его
-        prev_date_val = data[1]["analytics.cursor"][0]["PREV_DATE"]
+        prev_date_val = reader.cursor["PREV_DATE"]
         if prev_date_val is None:
             # Если предыдущая дата пустая - вероятно неправильный или несуществующий индекс запрошен
             raise Exception("Unknown index requested")
@@ -74,18 +237,12 @@ def get_security_data_from_moex(security: str):
 def get_security_data_by_isin_from_moex(isin: str = "RU000A105PU9"):
     # https://iss.moex.com/iss/securities.json?q=RU000A105PU9&iss.json=extended&iss.meta=off
 
-    url = "https://iss.moex.com/iss/securities.json?q="
-    url += isin
-    url += "&iss.json=extended&iss.meta=off"  # переводим в словарь из массива и отключаем метаданные
-
-    logger.debug(url)
-
     try:
-        response = requests.get(url, verify=False)
-        data = response.json()
+        data = iss_client.get_json("securities.json", {"q": isin})
     except Exception as e:
-        logger.error(f"Error during MOEX-index-positions request: {e}")
-        return []
+        # сетевую ошибку не выдаем за "не найдено" - пусть вызывающий решает
+        logger.error(f"Error during MOEX-securities request: {e}")
+        raise
 
     logger.debug(data)
     secs = data[1]['securities']
@@ -96,24 +253,39 @@ def get_security_data_by_isin_from_moex(isin: str = "RU000A105PU9"):
     return secs[0]["secid"], secs[0]["primary_boardid"]
 
 
-def get_splits_list_from_moex() -> List[Dict]:
-    """Получает список прошедших сплитов/консолидаций из MOEX API
+def get_securities_list_from_moex(market: str) -> Iterator[Dict]:
+    """Получает справочник торгуемых бумаг рынка фондовой секции МосБиржи постранично
+
+    Args:
+        market (str): рынок ISS - shares, bonds...
 
     Returns:
-        List[Dict]: список сплитов и их параметров
+        Iterator[Dict]: бумаги (secid, isin, primary_boardid, type, shortname...)
     """
-    splits_url = "https://iss.moex.com/iss/statistics/engines/stock/splits.json?iss.json=extended&iss.meta=off"
+    params = {"engine": "stock", "market": market, "is_trading": 1, "limit": 100}
+    yield from IssCursorReader("securities.json", "securities", params)
 
-    try:
-        response = requests.get(splits_url, verify=False)
-        data = response.json()
-    except Exception as e:
-        logger.error(f"Error during MOEX-splits request: {e}")
-        return []
 
+def get_splits_list_from_moex(since: date | None = None) -> Iterator[Dict]:
+    """Получает список прошедших сплитов/консолидаций из MOEX API постранично
+
+    Args:
+        since (date, optional): если задано - только сплиты с этой даты
+
+    Returns:
+        Iterator[Dict]: сплиты и их параметры
+
+    Raises:
+        Exception: ошибка запроса любой из страниц - чтобы неполный список не приняли за полный
+    """
+    params = {}
+    if since is not None:
+        params["from"] = since.strftime("%Y-%m-%d")
     try:
-        return data[1]["splits"]
+        for split in IssCursorReader("statistics/engines/stock/splits.json", "splits", params):
+            # фильтруем и сами - на случай, если ISS проигнорирует параметр from
+            if since is None or split["tradedate"] >= since.strftime("%Y-%m-%d"):
+                yield split
     except Exception as e:
-        logger.error(f"Error parsing MOEX-splits response: {e}")
-
-    return []
+        logger.error(f"Error during MOEX-splits request: {e}")
+        raise
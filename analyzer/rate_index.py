@@ -0,0 +1,118 @@
+import logging
+import threading
+
+from bisect import bisect_right
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Iterable
+
+from django.conf import settings
+
+from . import models, tasks
+
+rateLogger = logging.getLogger(__name__)
+rateLogger.setLevel(settings.CURRENCY_LOGGING_LEVEL)
+
+
+class CentrobankRateIndex():
+    """Курсы ЦБ РФ в памяти процесса.
+
+    По каждой валюте держит отсортированные списки дат и курсов и ищет по ним бисекцией
+    последний опубликованный курс на дату или раньше нее. ЦБ не публикует курсы на выходные
+    и праздники, поэтому точного совпадения может не быть - тогда сначала проверяется база
+    (курс мог сохранить другой процесс), а API запрашивается не больше одного раза на дату;
+    ответом служит ближайший предыдущий курс.
+    """
+
+    def __init__(self):
+        self._dates: dict[str, list[date]] = {}
+        self._rates: dict[str, list[Decimal]] = {}
+        self._checked: set[date] = set()  # даты, за которые уже запрашивали API
+        self._lock = threading.RLock()
+
+    def get_rate(self, on_date: date | datetime, currency: str) -> "models.CentrobankRate":
+        """Возвращает курс валюты на дату или последний опубликованный до нее
+
+        Args:
+            on_date (date | datetime): дата, на которую нужен курс
+            currency (str): код валюты
+
+        Raises:
+            CentrobankRate.DoesNotExist: если курса на эту дату и раньше нет совсем
+
+        Returns:
+            CentrobankRate: курс (не обязательно сохраненный в базе объект)
+        """
+        currency = currency.upper()
+        if isinstance(on_date, datetime):
+            on_date = on_date.date()
+        found_date, rate = self._resolve(on_date, currency)
+        return models.CentrobankRate(date=found_date, currency=currency, rate=rate)
+
+    def get_rates(self, pairs: Iterable[tuple[date, str]]) -> dict[tuple[date, str], Decimal]:
+        """Возвращает курсы для набора пар (дата, валюта).
+        Курсы каждой валюты читаются из базы одним запросом, дальше поиск идет в памяти.
+
+        Args:
+            pairs (Iterable[tuple[date, str]]): пары (дата, код валюты в верхнем регистре)
+
+        Raises:
+            CentrobankRate.DoesNotExist: если для какой-то пары курса нет совсем
+
+        Returns:
+            dict[tuple[date, str], Decimal]: курс по паре (дата, валюта)
+        """
+        return {(on_date, currency): self._resolve(on_date, currency)[1] for on_date, currency in pairs}
+
+    def _resolve(self, on_date: date, currency: str) -> tuple[date, Decimal]:
+        with self._lock:
+            found = self._lookup(on_date, currency)
+            need_api = (found is None or found[0] != on_date) and on_date not in self._checked
+
+        if need_api and models.CentrobankRate.objects.filter(currency=currency, date=on_date).exists():
+            # курс уже сохранил другой процесс - перечитываем базу вместо запроса к ЦБ
+            need_api = False
+            with self._lock:
+                self._dates.pop(currency, None)
+                found = self._lookup(on_date, currency)
+
+        if need_api:
+            # запрос к ЦБ идет без блокировки, чтобы не задерживать поиск других курсов
+            rateLogger.info(f"Need to get a rate for {currency} from CBRF for {on_date}")
+            tasks.get_cb_rate(on_date, currency)
+            with self._lock:
+                self._checked.add(on_date)
+                self._dates.pop(currency, None)
+                found = self._lookup(on_date, currency)
+
+        if found is None:
+            raise models.CentrobankRate.DoesNotExist(f"No CBRF rate for {currency} on {on_date} or earlier")
+        return found
+
+    def invalidate(self, currency: str | None = None):
+        """Сбрасывает загруженные курсы валюты (или всех валют), чтобы перечитать их из базы"""
+        with self._lock:
+            if currency is None:
+                self._dates.clear()
+                self._rates.clear()
+            else:
+                self._dates.pop(currency.upper(), None)
+                self._rates.pop(currency.upper(), None)
+
+    def _lookup(self, on_date: date, currency: str) -> tuple[date, Decimal] | None:
+        if currency not in self._dates:
+            self._load(currency)
+        dates = self._dates[currency]
+        i = bisect_right(dates, on_date)
+        if i == 0:
+            return None
+        return dates[i - 1], self._rates[currency][i - 1]
+
+    def _load(self, currency: str):
+        rateLogger.debug(f"Loading CBRF rates for {currency} from DB")
+        rows = models.CentrobankRate.objects.filter(currency=currency).order_by("date").values_list("date", "rate")
+        self._dates[currency] = [row[0] for row in rows]
+        self._rates[currency] = [row[1] for row in rows]
+
+
+centrobank_rate_index = CentrobankRateIndex()
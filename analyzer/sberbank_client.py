@@ -64,6 +64,7 @@ def parse_instruments_list(soup: BeautifulSoup | Tag) -> "Dict[str, models.Instr
     sberLogger.info("Start Sberbank HTML report instrument list parsing")
 
     instruments = {}
+    rows = []
 
     for row in soup.find_all("tr"):
         if row.has_attr('class') and row['class'][0] in ["table-header", "rn", "summary-row"]:
@@ -76,20 +77,20 @@ def parse_instruments_list(soup: BeautifulSoup | Tag) -> "Dict[str, models.Instr
         name_col = 0
         ticker_col = 1
         isin_col = 2
-        name = cells[name_col].string
-        ticker = cells[ticker_col].string
-        isin = cells[isin_col].string
-        try:
-            instrument = models.Instrument.get_instrument_by_ticker(ticker, "TQBR")
-        except Exception as e:
-            sberLogger.error(f"Ошибка парсинга инструмента: {e}")
-        try:
-            sberLogger.info(f"Пробуем найти по ISIN {isin}")
-            instrument = models.Instrument.get_instrument_by_isin(isin)
-            sberLogger.info(f"Успешно нашли {instrument}!")
-        except Exception as e:
-            sberLogger.error(f"Ошибка парсинга инструмента: {e}")
+        rows.append((cells[name_col].string, cells[ticker_col].string, cells[isin_col].string))
+
+    # ищем все инструменты пачками: сначала по тикеру на TQBR,
+    # а облигации и прочее не с TQBR - по ISIN через справочник МосБиржи
+    by_ticker = models.Instrument.get_instruments([f"{ticker}:TQBR" for _, ticker, _ in rows], "ticker")
+    by_isin = models.Instrument.get_instruments(
+        [isin for _, ticker, isin in rows if f"{ticker}:TQBR" not in by_ticker], "isin")
+
+    for name, ticker, isin in rows:
+        instrument = by_ticker.get(f"{ticker}:TQBR") or by_isin.get(isin)
+        if instrument is None:
+            sberLogger.error(f"Инструмент '{name}' ({ticker}, {isin}) не найден")
             continue
+        sberLogger.info(f"Успешно нашли {instrument}!")
         instruments[name] = instrument
         instruments[ticker] = instrument
         instruments[isin] = instrument
@@ -338,6 +339,7 @@ def parse_money_operations(soup: BeautifulSoup, account: "models.Account",
 def parse_portfolio(soup: BeautifulSoup, account: "models.Account"):
     sberLogger.info("Start Sberbank HTML report portfolio parsing")
 
+    rows = []
     for row in soup.find_all("tr"):
         if row.has_attr('class') and row['class'][0] in ["table-header", "rn", "summary-row"]:
             # не парсим ряды заголовков и концевые
@@ -353,12 +355,14 @@ def parse_portfolio(soup: BeautifulSoup, account: "models.Account"):
         isin = cells[isin_col].string
         end_date_qtty = cells[end_date_qtty_col].string.replace(" ", "")
         sberLogger.debug(f"'{name}', isin: {isin} количество в конце периода: {end_date_qtty}")
-        try:
-            instrument = models.Instrument.get_instrument_by_isin(isin)
-            sberLogger.debug(instrument)
-        except Exception as e:
-            sberLogger.warning(f"Ошибка вненсения инструмента {name}")
-            sberLogger.error(f"Ошибка поиска инструмента для {isin}:\n{e}")
+        rows.append((name, isin, end_date_qtty))
+
+    instruments = models.Instrument.get_instruments([isin for _, isin, _ in rows], "isin")
+    for name, isin, end_date_qtty in rows:
+        instrument = instruments.get(isin)
+        sberLogger.debug(instrument)
+        if instrument is None:
+            sberLogger.warning(f"Инструмент {name} ({isin}) не найден - позиция не внесена")
             continue
         _put_sberbank_position(account, instrument, end_date_qtty)
     pass
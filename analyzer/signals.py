@@ -0,0 +1,64 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .holdings import holdings_aggregator
+from .instrument_cache import instrument_cache
+from .models import (CentrobankRate, Instrument, InstrumentData, LastPrice, Position, Split, TargetPortfolio,
+                     TargetPortfolioValues)
+from .rate_index import centrobank_rate_index
+from .splits import split_adjuster
+from .tasks import LAST_PRICES_VERSION_KEY, target_portfolio_values_version_key
+from .utils import bump_cache_version
+
+
+@receiver([post_save, post_delete], sender=InstrumentData)
+def instrument_data_changed(sender, instance: InstrumentData, **kwargs):
+    instrument_cache.invalidate_instrument(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Instrument)
+def instrument_id_changed(sender, instance: Instrument, **kwargs):
+    instrument_cache.invalidate_key(instance.idType, instance.idValue)
+
+
+@receiver([post_save, post_delete], sender=CentrobankRate)
+def centrobank_rate_changed(sender, instance: CentrobankRate, **kwargs):
+    centrobank_rate_index.invalidate(instance.currency)
+
+
+@receiver([post_save, post_delete], sender=Split)
+def split_changed(sender, instance: Split, **kwargs):
+    split_adjuster.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Position)
+def position_changed(sender, instance: Position, **kwargs):
+    holdings_aggregator.invalidate_accounts([instance.account_id])
+
+
+@receiver(m2m_changed, sender=TargetPortfolio.accounts.through)
+def target_portfolio_accounts_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # после clear связей уже нет - запоминаем портфели счета заранее
+        instance._cleared_target_portfolio_pks = list(instance.targetportfolio_set.values_list("pk", flat=True))
+        return
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        holdings_aggregator.invalidate_portfolio(instance.pk)
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_target_portfolio_pks", [])
+        instance._cleared_target_portfolio_pks = []
+    for pk in pk_set:
+        holdings_aggregator.invalidate_portfolio(pk)
+
+
+@receiver([post_save, post_delete], sender=TargetPortfolioValues)
+def target_portfolio_values_changed(sender, instance: TargetPortfolioValues, **kwargs):
+    bump_cache_version(target_portfolio_values_version_key(instance.targetPortfolio_id))
+
+
+@receiver([post_save, post_delete], sender=LastPrice)
+def last_price_changed(sender, instance: LastPrice, **kwargs):
+    bump_cache_version(LAST_PRICES_VERSION_KEY)
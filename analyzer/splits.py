@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+
+from bisect import bisect_right
+from datetime import date, datetime
+from decimal import Decimal
+from fractions import Fraction
+from typing import Iterable
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from . import models
+
+splitLogger = logging.getLogger(__name__)
+splitLogger.setLevel(settings.PORTFOLIO_LOGGING_LEVEL)
+
+
+class SplitAdjuster():
+    """Пересчет количества и цены операций с учетом сплитов/консолидаций.
+
+    По каждому тикеру держит отсортированные даты сплитов и накопленные множители:
+    для даты операции множитель - произведение after/before всех сплитов после нее.
+    Количество умножается на множитель, а цена делится на него, так что вся история
+    приводится к текущему количеству бумаг. Множители считаются один раз из таблицы Split
+    и сбрасываются сигналами, когда в нее приходят новые записи. Сплиты пишет и синхронизация
+    в другом процессе, поэтому не чаще раза в VERSION_CHECK_INTERVAL версия таблицы
+    (максимальный id и количество записей) сверяется с базой.
+    """
+
+    VERSION_CHECK_INTERVAL = 60  # секунд между сверками версии таблицы Split с базой
+
+    def __init__(self):
+        # ticker -> (даты сплитов, накопленные множители); множитель [i] - для дат до dates[i]
+        self._factors: dict[str, tuple[list[date], list[Fraction]]] | None = None
+        self._version: tuple[int | None, int] | None = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def factor(self, ticker: str, on_date: date | datetime) -> Fraction:
+        """Возвращает множитель количества для операции с бумагой на дату
+
+        Args:
+            ticker (str): тикер бумаги
+            on_date (date | datetime): дата операции
+
+        Returns:
+            Fraction: множитель, 1 - если сплитов после даты не было
+        """
+        if isinstance(on_date, datetime):
+            on_date = on_date.date()
+        factors = self._get_factors().get(ticker)
+        if factors is None:
+            return Fraction(1)
+        dates, cumulative = factors
+        i = bisect_right(dates, on_date)
+        if i == len(dates):
+            return Fraction(1)
+        return cumulative[i]
+
+    def adjust_operations(self, operations: "Iterable[models.Operation]") -> "list[models.Operation]":
+        """Проставляет операциям количество и цену с учетом последующих сплитов -
+        в атрибуты quantity_adjusted и price_adjusted.
+
+        Args:
+            operations (Iterable[Operation]): операции (instrument должен быть подгружен)
+
+        Returns:
+            list[Operation]: те же операции
+        """
+        operations = list(operations)
+        for op in operations:
+            factor = Fraction(1)
+            if op.instrument is not None:
+                factor = self.factor(op.instrument.ticker, op.timestamp)
+            if factor == 1:
+                op.quantity_adjusted = op.quantity
+                op.price_adjusted = op.price
+                continue
+            quantity = op.quantity * factor
+            if quantity.denominator == 1:
+                op.quantity_adjusted = int(quantity)
+            else:
+                op.quantity_adjusted = Decimal(quantity.numerator) / Decimal(quantity.denominator)
+            op.price_adjusted = op.price * Decimal(factor.denominator) / Decimal(factor.numerator)
+        return operations
+
+    def invalidate(self):
+        with self._lock:
+            self._factors = None
+
+    def _get_factors(self) -> dict[str, tuple[list[date], list[Fraction]]]:
+        with self._lock:
+            now = time.monotonic()
+            if self._factors is not None and now - self._checked_at >= self.VERSION_CHECK_INTERVAL:
+                self._checked_at = now
+                if self._load_version() != self._version:
+                    splitLogger.info("Splits table changed - reloading split factors")
+                    self._factors = None
+            if self._factors is None:
+                self._version = self._load_version()
+                self._checked_at = now
+                self._factors = self._load()
+            return self._factors
+
+    @staticmethod
+    def _load_version() -> tuple[int | None, int]:
+        version = models.Split.objects.aggregate(Max("id"), Count("id"))
+        return version["id__max"], version["id__count"]
+
+    def _load(self) -> dict[str, tuple[list[date], list[Fraction]]]:
+        splitLogger.debug("Loading splits from DB")
+        by_ticker: dict[str, list[tuple[date, Fraction]]] = {}
+        for ticker, split_date, before, after in models.Split.objects.order_by("ticker", "date").values_list(
+                "ticker", "date", "before", "after"):
+            if before == 0 or after == 0:
+                splitLogger.warning(f"Skipping broken split of {ticker} on {split_date}: {before} -> {after}")
+                continue
+            by_ticker.setdefault(ticker, []).append((split_date, Fraction(after, before)))
+
+        factors = {}
+        for ticker, splits in by_ticker.items():
+            # накопленное произведение с конца: для дат до i-го сплита действуют он и все следующие
+            cumulative = [Fraction(1)] * len(splits)
+            product = Fraction(1)
+            for i in range(len(splits) - 1, -1, -1):
+                product *= splits[i][1]
+                cumulative[i] = product
+            factors[ticker] = ([split[0] for split in splits], cumulative)
+        return factors
+
+
+split_adjuster = SplitAdjuster()
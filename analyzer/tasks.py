@@ -1,14 +1,25 @@
+import asyncio
+import heapq
 import logging
 import tempfile
 
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
-from django.db.utils import IntegrityError
+from django.db import transaction
+from django.db.models import Case, DecimalField, ExpressionWrapper, F, Max, OuterRef, Subquery, Sum, When
+from django.db.models.functions import Coalesce
 from . import models  # import Account, Instrument, Operation
 from . import tclient, cbrf_client, moex_client, sberbank_client
 from .classes import Quotation
+from .holdings import holdings_aggregator
+from .instrument_cache import instrument_cache
+from .rate_index import centrobank_rate_index
+from .splits import split_adjuster
+from .utils import bump_cache_version, get_cache_versions
 
 
 tinkoff_client = tclient.tinkoff_client(settings.TINKOFF_API_KEY)
@@ -16,6 +27,21 @@ tinkoff_client = tclient.tinkoff_client(settings.TINKOFF_API_KEY)
 taskLogger = logging.getLogger(__name__)
 taskLogger.setLevel(settings.TASKS_LOGGING_LEVEL)
 
+OPERATIONS_BATCH_SIZE = 500  # размер пачки при проверке и записи операций в базу
+INSTRUMENTS_BATCH_SIZE = 500  # размер пачки при записи инструментов и их идентификаторов
+RATES_BATCH_SIZE = 1000  # размер пачки при записи курсов ЦБ РФ
+# Основные режимы торгов МосБиржи: при нескольких листингах одного ISIN запись InstrumentData
+# строится по листингу из первого найденного здесь режима, остальные листинги дают только идентификаторы
+PRIMARY_CLASS_CODES = ["TQBR", "TQCB", "TQOB", "TQTF", "TQIR", "CETS"]
+
+# типы инструментов справочника и методы клиента для их списочной загрузки
+CATALOG_INSTRUMENT_TYPES = {
+    "share": "get_shares",
+    "bond": "get_bonds",
+    "etf": "get_etfs",
+    "currency": "get_currencies",
+}
+
 
 def update_tinkoff_accounts():
     accounts_in = tinkoff_client.get_accounts()
@@ -35,47 +61,78 @@ def update_tinkoff_accounts():
 def get_cb_rate(date: datetime, currency: str):
     taskLogger.info(f"Get cb_rate from API for '{currency}' on {date}.")
     currency = currency.upper()
+    if isinstance(date, datetime):
+        date = date.date()
     rates = cbrf_client.get_rates_for_date_from_cbrf(date)
-    outRate = None
 
-    currencies = models.Currency.objects.all()
-    for tmpCurrency in currencies:
-        rate = rates[tmpCurrency.code]
+    day_rates = {}
+    for code in models.Currency.objects.values_list("code", flat=True):
+        rate = rates[code]
         if rate is None:
             continue
-        taskLogger.info(f"Parsing rate of '{tmpCurrency}' from API.")
-        tmpRate = models.CentrobankRate.objects.get_or_create(
-            date=date,
-            currency=rate.currency.code,
-            defaults={"rate": rate.value}
-        )[0]
-        if rate.currency.code.__str__() == currency:
-            outRate = models.CentrobankRate.objects.get(pk=tmpRate.pk)
-    # чтобы в базе были курсы для рубля, а не ошибку каждый раз обрабатывать
-    tmpRate = models.CentrobankRate.objects.get_or_create(
-            date=date,
-            currency="RUB",
-            defaults={"rate": Decimal(1)}
-        )[0]
-    if currency == "RUB":
-        outRate = models.CentrobankRate.objects.get(pk=tmpRate.pk)
-    return outRate
+        day_rates[rate.currency.code] = rate.value
+    store_cb_rates({date: day_rates})
+    return models.CentrobankRate.objects.filter(date=date, currency=currency).first()
 
 
 def get_cb_rate_dynamics(currency: str, start_date: datetime, end_date: datetime = datetime.now()):
-    rates = cbrf_client.get_rate_dynamics_from_cbrf(currency, start_date, end_date)
+    return load_cb_rates([currency], start_date, end_date)
+
+
+def load_cb_rates(currencies: list[str], start_date: datetime, end_date: datetime | None = None) -> int:
+    """Загружает динамику курсов нескольких валют за период и записывает ее в базу одной пачкой.
+    Подходит для заполнения истории курсов за много лет: по одному запросу в ЦБ на валюту.
+
+    Args:
+        currencies (list[str]): коды валют
+        start_date (datetime): начало периода
+        end_date (datetime, optional): конец периода, по умолчанию - сейчас
+
+    Returns:
+        int: количество добавленных курсов (без рублевых)
+    """
+    if end_date is None:
+        end_date = datetime.now()
+    rates: dict[date, dict[str, Decimal]] = {}
+    for currency in currencies:
+        taskLogger.info(f"Get rates dynamics for '{currency}' from {start_date} to {end_date}")
+        for rate_date, rate in cbrf_client.get_rate_dynamics_from_cbrf(currency, start_date, end_date).items():
+            if isinstance(rate_date, datetime):
+                rate_date = rate_date.date()
+            rates.setdefault(rate_date, {})[rate.currency.code] = rate.value
+    return store_cb_rates(rates)
+
+
+def store_cb_rates(rates: "dict[date, dict[str, Decimal]]") -> int:
+    """Записывает курсы ЦБ РФ в базу одним bulk_create, пропуская уже существующие.
+    На каждую дату добавляется и рубль с курсом 1, чтобы не обрабатывать его отдельно.
+
+    Args:
+        rates (dict[date, dict[str, Decimal]]): курсы по дате и коду валюты
+
+    Returns:
+        int: количество добавленных курсов (без рублевых)
+    """
+    if len(rates) == 0:
+        return 0
+    currencies = set(code for day_rates in rates.values() for code in day_rates) | {"RUB"}
+    existing = set(models.CentrobankRate.objects.filter(
+        date__range=(min(rates), max(rates)), currency__in=currencies).values_list("date", "currency"))
+
+    new_rates = []
     count = 0
-    for date, rate in rates.items():
-        _, created = models.CentrobankRate.objects.get_or_create(
-            date=date,
-            currency=rate.currency.code,
-            defaults={"rate": rate.value}
-        )
-        if created:
-            # Добавляем рубль, чтобы не создавать исключений по запросам в базу данных
-            models.CentrobankRate.objects.get_or_create(date=date, currency="RUB",
-                                                        defaults={"rate": Decimal(1)})
-            count += 1
+    for rate_date, day_rates in rates.items():
+        for code, value in list(day_rates.items()) + [("RUB", Decimal(1))]:
+            if (rate_date, code) in existing:
+                continue
+            new_rates.append(models.CentrobankRate(date=rate_date, currency=code, rate=value))
+            if code != "RUB":
+                count += 1
+    if len(new_rates) > 0:
+        # bulk_create не вызывает сигналы, поэтому индекс курсов сбрасываем сами
+        models.CentrobankRate.objects.bulk_create(new_rates, batch_size=RATES_BATCH_SIZE, ignore_conflicts=True)
+        centrobank_rate_index.invalidate()
+    taskLogger.info(f"Stored {count} CBRF rates for {len(rates)} dates")
     return count
 
 
@@ -86,14 +143,72 @@ def get_instrument_by_figi(figi: str):
 
 
 def get_instrument_by_isin(isin: str):
-    taskLogger.warning(f"Get instrument by isin {isin}")
-    ticker, board = moex_client.get_security_data_by_isin_from_moex(isin)
-    taskLogger.warning(f"{ticker} - {board}")
-    if ticker is None or board is None:
+    taskLogger.debug(f"Get instrument by isin {isin}")
+    resolved = models.MoexSecurity.resolve_isins([isin])
+    if isin not in resolved:
+        raise LookupError(f"Cannot resolve ISIN {isin} on MOEX")
+    if resolved[isin] is None:
         return None
+    ticker, board = resolved[isin]
     return get_instrument_by_ticker(ticker, board)
 
 
+def refresh_moex_securities(markets: list[str] | None = None) -> int:
+    """Обновляет локальный справочник бумаг МосБиржи целиком по спискам ISS
+
+    Args:
+        markets (list[str], optional): рынки ISS, по умолчанию - MOEX_SECURITIES_MARKETS
+
+    Returns:
+        int: количество записанных бумаг
+    """
+    if markets is None:
+        markets = settings.MOEX_SECURITIES_MARKETS
+    now = datetime.now(timezone.utc)
+    securities = {}
+    for market in markets:
+        taskLogger.info(f"Loading MOEX securities directory for '{market}'")
+        for row in moex_client.get_securities_list_from_moex(market):
+            securities[row["secid"]] = models.MoexSecurity(
+                secid=row["secid"],
+                isin=row.get("isin") or "",
+                primary_boardid=row.get("primary_boardid") or "",
+                type=row.get("type") or "",
+                shortname=(row.get("shortname") or "")[:128],
+                updated=now,
+            )
+    models.MoexSecurity.objects.bulk_create(
+        securities.values(),
+        batch_size=INSTRUMENTS_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["secid"],
+        update_fields=["isin", "primary_boardid", "type", "shortname", "updated"],
+    )
+    taskLogger.info(f"Stored {len(securities)} MOEX securities")
+    return len(securities)
+
+
+def search_moex_isins(isins: "set[str]") -> "dict[str, tuple[str, str] | None]":
+    """Поштучный поиск ISIN в ISS - для бумаг, которых нет в локальном справочнике
+
+    Returns:
+        dict[str, tuple[str, str] | None]: (secid, primary_boardid) по ISIN или None, если бумаги нет.
+            ISIN с сетевой ошибкой в ответ не попадают.
+    """
+    out = {}
+    for isin in isins:
+        try:
+            ticker, board = moex_client.get_security_data_by_isin_from_moex(isin)
+        except Exception as e:
+            taskLogger.error(f"Cannot search ISIN {isin} on MOEX: {e}")
+            continue
+        if ticker is None or board is None:
+            out[isin] = None
+        else:
+            out[isin] = (ticker, board)
+    return out
+
+
 def get_instrument_by_ticker(ticker: str, class_code: str):
     taskLogger.debug(f"Get instrument by ticker {ticker}")
     instrument_in = tinkoff_client.get_instrument_by_ticker(ticker, class_code)
@@ -106,7 +221,74 @@ def get_instrument_by_uid(uid: str):
     return _process_instrument(instrument_in)
 
 
-def _process_instrument(instrument_in, instrument_type=""):
+def get_instruments_from_api(ids: list[str], idType: str) -> "dict[str, models.InstrumentData]":
+    """Параллельно запрашивает пачку инструментов из API и сохраняет их в базу.
+    Запросы идут из нескольких потоков, а запись в базу - последовательно.
+
+    Args:
+        ids (list[str]): идентификаторы, для ticker - в виде "ticker:class_code"
+        idType (str): тип идентификаторов (figi, isin, ticker, uid)
+
+    Returns:
+        dict[str, models.InstrumentData]: сохраненные инструменты по идентификатору
+    """
+    out = {}
+    not_found = {}  # идентификаторы, которых точно нет в API, и причина
+    search = {id: (id, idType) for id in ids}
+    if idType == "isin":
+        # ISIN переводим в тикер и режим торгов МосБиржи сразу для всей пачки
+        resolved = models.MoexSecurity.resolve_isins(ids)
+        search = {}
+        for id in ids:
+            if id not in resolved:
+                continue
+            if resolved[id] is None:
+                not_found[id] = "Not found on MOEX"
+                continue
+            search[id] = (":".join(resolved[id]), "ticker")
+    with ThreadPoolExecutor(max_workers=settings.INSTRUMENT_FETCH_CONCURRENCY) as executor:
+        futures = {id: executor.submit(_fetch_instrument_from_api, *search[id]) for id in search}
+    for id, future in futures.items():
+        try:
+            fetched = future.result()
+        except Exception as e:
+            taskLogger.error(f"Cannot get instrument by {idType} {id} from API: {e}")
+            if tclient.is_not_found_error(e):
+                not_found[id] = str(e)
+            continue
+        instrument_in, share = fetched
+        out[id] = _process_instrument(instrument_in, share=share)
+    models.UnresolvedInstrument.objects.remember_many(not_found, idType)
+    return out
+
+
+def _fetch_instrument_from_api(id: str, idType: str):
+    """Запрашивает инструмент из API, а для акций - сразу и данные акции
+
+    Args:
+        id (str): идентификатор, для ticker - в виде "ticker:class_code"
+        idType (str): тип идентификатора (figi, ticker, uid)
+
+    Returns:
+        tuple: (инструмент, акция или None)
+    """
+    if idType == "figi":
+        instrument_in = tinkoff_client.get_instrument_by_figi(id)
+    elif idType == "ticker":
+        ticker, class_code = id.split(":", 1)
+        instrument_in = tinkoff_client.get_instrument_by_ticker(ticker, class_code)
+    elif idType == "uid":
+        instrument_in = tinkoff_client.get_instrument_by_uid(id)
+    else:
+        raise ValueError(f"Unknown instrument id type '{idType}'")
+
+    share = None
+    if instrument_in.instrument_type == "share":
+        share = tinkoff_client.get_share(instrument_in.figi)
+    return instrument_in, share
+
+
+def _process_instrument(instrument_in, instrument_type="", share=None):
     instrument = models.instrument_from_tinkoff_client(instrument_in, instrument_type)
     try:
         tmp = models.InstrumentData.objects.get(isin=instrument.isin)
@@ -115,45 +297,194 @@ def _process_instrument(instrument_in, instrument_type=""):
     except models.InstrumentData.DoesNotExist:
         instrument.save()
 
-    _put_instrument_ids(instrument)
+    put_instrument_ids([instrument])
 
     if instrument.instrument_type == "share":
-        share = tinkoff_client.get_share(instrument.figi)
+        if share is None:
+            share = tinkoff_client.get_share(instrument.figi)
         instrument.populate_share_fields(share)
         instrument.save()
 
     return instrument
 
 
-def _put_instrument_ids(instrument):
-    taskLogger.debug(f"Updating ids for {instrument}")
-    taskLogger.debug(f"Remove old ids for {instrument}")
-    models.Instrument.objects.filter(instrumentData=instrument).delete()
+def _listing_ids(listing: "models.InstrumentData") -> "list[tuple[str, str]]":
+    return [
+        ("figi", listing.figi),
+        ("isin", listing.isin),
+        ("ticker", listing.ticker + ":" + listing.class_code),
+        ("uid", listing.uid),
+    ]
 
-    taskLogger.debug(f"Putting figi {instrument.figi}")
-    models.Instrument.objects.update_or_create(
-        idType="figi",
-        idValue=instrument.figi,
-        defaults={"instrumentData": instrument}
-    )
-    taskLogger.debug(f"Putting isin {instrument.isin}")
-    models.Instrument.objects.update_or_create(
-        idType="isin",
-        idValue=instrument.isin,
-        defaults={"instrumentData": instrument}
-    )
-    taskLogger.debug(f"Putting ticker {instrument.ticker}")
-    models.Instrument.objects.update_or_create(
-        idType="ticker",
-        idValue=instrument.ticker + ":" + instrument.class_code,
-        defaults={"instrumentData": instrument}
-    )
-    taskLogger.debug(f"Putting uid {instrument.uid}")
-    models.Instrument.objects.update_or_create(
-        idType="uid",
-        idValue=instrument.uid,
-        defaults={"instrumentData": instrument}
-    )
+
+def put_instrument_ids(instruments: "list[models.InstrumentData]",
+                       other_listings: "dict[str, list[models.InstrumentData]] | None" = None):
+    """Записывает идентификаторы (figi, isin, ticker:class_code, uid) сразу для пачки инструментов.
+    Старые идентификаторы этих инструментов удаляются, а новые пишутся одним upsert по (idType, idValue) -
+    если идентификатор был закреплен за другим инструментом, он переезжает на новый.
+
+    Args:
+        instruments (list[models.InstrumentData]): сохраненные в базе инструменты
+        other_listings (dict[str, list[InstrumentData]], optional): прочие листинги тех же бумаг по ISIN -
+            их идентификаторы тоже закрепляются за записью бумаги
+    """
+    taskLogger.debug(f"Updating ids for {len(instruments)} instruments")
+    if other_listings is None:
+        other_listings = {}
+    rows = {}
+    for instrument in instruments:
+        ids = []
+        for listing in other_listings.get(instrument.isin, []):
+            ids += _listing_ids(listing)
+        # идентификаторы основного листинга пишутся последними и перекрывают совпадающие
+        ids += _listing_ids(instrument)
+        for idType, idValue in ids:
+            if idValue == "" or idValue == ":":
+                continue
+            rows[(idType, idValue)] = models.Instrument(idType=idType, idValue=idValue, instrumentData=instrument)
+
+    # bulk_create не отправляет сигналов - сбрасываем кэш инструментов вручную
+    for idType, idValue in rows.keys():
+        instrument_cache.invalidate_key(idType, idValue)
+
+    with transaction.atomic():
+        models.Instrument.objects.filter(instrumentData__in=instruments).delete()
+        models.Instrument.objects.bulk_create(
+            rows.values(),
+            batch_size=INSTRUMENTS_BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=["idType", "idValue"],
+            update_fields=["instrumentData"],
+        )
+
+
+def refresh_instrument_ids():
+    """Перестраивает идентификаторы для всех инструментов в базе"""
+    instruments = list(models.InstrumentData.objects.all())
+    taskLogger.info(f"Refreshing ids for {len(instruments)} instruments")
+    for start in range(0, len(instruments), INSTRUMENTS_BATCH_SIZE):
+        put_instrument_ids(instruments[start:start + INSTRUMENTS_BATCH_SIZE])
+
+
+def preload_instruments_catalog(instrument_types: list[str] | None = None) -> int:
+    """Загружает в базу полный справочник инструментов Т-Банка списочными запросами
+    (shares, bonds, etfs, currencies) - по одному запросу на тип инструмента.
+
+    Args:
+        instrument_types (list[str], optional): типы инструментов, по умолчанию - все из CATALOG_INSTRUMENT_TYPES
+
+    Returns:
+        int: количество записанных инструментов
+    """
+    if instrument_types is None:
+        instrument_types = list(CATALOG_INSTRUMENT_TYPES.keys())
+    total = 0
+    for instrument_type in instrument_types:
+        taskLogger.info(f"Loading {instrument_type} catalog from API")
+        instruments_in = getattr(tinkoff_client, CATALOG_INSTRUMENT_TYPES[instrument_type])()
+        count = store_instruments_catalog(instruments_in, instrument_type)
+        taskLogger.info(f"Stored {count} instruments of type {instrument_type}")
+        total += count
+    return total
+
+
+def store_instruments_catalog(instruments_in, instrument_type: str) -> int:
+    """Записывает в базу пачку инструментов одного типа из справочника API вместе с их идентификаторами.
+    Как и в _process_instrument, на один ISIN приходится одна запись InstrumentData: если бумага
+    торгуется в нескольких режимах, запись строится по основному листингу (см. PRIMARY_CLASS_CODES),
+    а figi/uid/тикеры остальных листингов тоже закрепляются за ней.
+
+    Args:
+        instruments_in (list): Share/Bond/Etf/Currency из API
+        instrument_type (str): тип инструментов (share, bond, etf, currency)
+
+    Returns:
+        int: количество записанных инструментов
+    """
+    listings = {}
+    for instrument_in in instruments_in:
+        try:
+            instrument = models.instrument_from_tinkoff_client(instrument_in, instrument_type)
+            if instrument_type == "share":
+                instrument.populate_share_fields(instrument_in)
+        except Exception as e:
+            taskLogger.warning(f"Cannot parse {instrument_type} {getattr(instrument_in, 'uid', '')}: {e}")
+            continue
+        listings.setdefault(instrument.isin, []).append(instrument)
+
+    instruments = {}
+    other_listings = {}
+    for isin, isin_listings in listings.items():
+        # детерминированный выбор основного листинга - не зависит от порядка ответа API
+        isin_listings.sort(key=_listing_priority)
+        instruments[isin] = isin_listings[0]
+        if len(isin_listings) > 1:
+            other_listings[isin] = isin_listings[1:]
+
+    existing_by_uid = {}
+    existing_by_isin = {}
+    for pk, isin, uid in models.InstrumentData.objects.values_list("pk", "isin", "uid"):
+        existing_by_uid[uid] = pk
+        existing_by_isin[isin] = pk
+
+    now = datetime.now(tz=timezone.utc)
+    to_create = []
+    to_update = {}
+    for instrument in instruments.values():
+        instrument.updated = now  # bulk_update не обновляет auto_now поля
+        instrument.pk = existing_by_uid.get(instrument.uid, existing_by_isin.get(instrument.isin))
+        if instrument.pk is None:
+            to_create.append(instrument)
+        else:
+            to_update[instrument.pk] = instrument
+
+    update_fields = [field.name for field in models.InstrumentData._meta.concrete_fields if not field.primary_key]
+    with transaction.atomic():
+        models.InstrumentData.objects.bulk_create(to_create, batch_size=INSTRUMENTS_BATCH_SIZE)
+        models.InstrumentData.objects.bulk_update(to_update.values(), update_fields,
+                                                  batch_size=INSTRUMENTS_BATCH_SIZE)
+    for pk in to_update.keys():
+        instrument_cache.invalidate_instrument(pk)
+
+    # после bulk_create не на всех базах проставляются pk - поэтому перечитываем записанное
+    uids = [instrument.uid for instrument in instruments.values()]
+    for start in range(0, len(uids), INSTRUMENTS_BATCH_SIZE):
+        stored = list(models.InstrumentData.objects.filter(uid__in=uids[start:start + INSTRUMENTS_BATCH_SIZE]))
+        put_instrument_ids(stored, other_listings)
+
+    return len(to_create) + len(to_update)
+
+
+def _listing_priority(listing: "models.InstrumentData") -> tuple:
+    """Ключ сортировки листингов одного ISIN: сначала основные режимы МосБиржи по порядку"""
+    if listing.class_code in PRIMARY_CLASS_CODES:
+        return (0, PRIMARY_CLASS_CODES.index(listing.class_code), listing.uid)
+    return (1, listing.class_code, listing.uid)
+
+
+def refresh_instruments(uids: list[str], instrument_type: str) -> int:
+    """Обновляет из API пачку инструментов одного типа.
+    Большие пачки типов из справочника обновляются одним списочным запросом,
+    остальные - параллельными запросами по каждому инструменту.
+
+    Args:
+        uids (list[str]): uid инструментов
+        instrument_type (str): тип инструментов
+
+    Returns:
+        int: количество обновленных инструментов
+    """
+    refreshed = 0
+    if instrument_type in CATALOG_INSTRUMENT_TYPES and len(uids) >= settings.INSTRUMENT_REFRESH_BULK_THRESHOLD:
+        wanted = set(uids)
+        catalog = getattr(tinkoff_client, CATALOG_INSTRUMENT_TYPES[instrument_type])()
+        instruments_in = [instrument_in for instrument_in in catalog if instrument_in.uid in wanted]
+        refreshed += store_instruments_catalog(instruments_in, instrument_type)
+        # чего нет в справочнике (например, уже не торгуется) - запрашиваем по одному
+        uids = list(wanted - set(instrument_in.uid for instrument_in in instruments_in))
+    if len(uids) > 0:
+        refreshed += len(get_instruments_from_api(uids, "uid"))
+    return refreshed
 
 
 def get_lastprice_from_api(figi_in: str | list[str]):
@@ -176,6 +507,8 @@ def get_lastprice_from_api(figi_in: str | list[str]):
 
         cache_key = f"last_price_{price.figi}"
         cache.set(cache_key, Quotation(price.price).to_decimal(), 60)
+    # update() не вызывает сигналов - сбрасываем зависящие от цен итоги сами
+    bump_cache_version(LAST_PRICES_VERSION_KEY)
     # возвращаем сведения о последнем/единственном инструменте
     return models.LastPrice.objects.get(figi=price.figi)
 
@@ -190,55 +523,138 @@ def get_tinkoff_operations(accountId: str,
                            endDate: datetime | None = None,
                            figi: str = "") -> int:
     operations = tinkoff_client.get_operations(accountId, startDate, endDate, figi)
-    op_count = 0
-    for operation in operations:
-        op_out = models.operation_from_tinkoff_client(operation, accountId)
-        try:
-            models.Operation.objects.get(operationId=op_out.operationId)
-        except models.Operation.DoesNotExist:
-            op_count += 1
-            op_out.save()
-    return op_count
+    return store_tinkoff_operations(accountId, operations)
+
+
+def store_tinkoff_operations(accountId: str, operations) -> int:
+    """Сохраняет в базу полученные из API операции счета, пропуская уже существующие.
+    Существование проверяется одним запросом на пачку, новые операции пишутся
+    через bulk_create в одной транзакции.
+
+    Returns:
+        int: количество добавленных операций
+    """
+    # API может вернуть одну операцию дважды - оставляем последнюю
+    operations_by_id = {operation.id: operation for operation in operations}
+    operation_ids = list(operations_by_id.keys())
+
+    new_operations = []
+    for start in range(0, len(operation_ids), OPERATIONS_BATCH_SIZE):
+        chunk = operation_ids[start:start + OPERATIONS_BATCH_SIZE]
+        existing = set(models.Operation.objects.filter(
+            operationId__in=chunk).values_list("operationId", flat=True))
+        new_operations += [operations_by_id[op_id] for op_id in chunk if op_id not in existing]
+
+    # инструменты могут подгружаться из API - поэтому до начала транзакции
+    ops_out = models.operations_from_tinkoff_client(new_operations, accountId)
+
+    with transaction.atomic():
+        models.Operation.objects.bulk_create(ops_out, batch_size=OPERATIONS_BATCH_SIZE, ignore_conflicts=True)
+
+    skipped = len(operations) - len(ops_out)
+    taskLogger.info(f"Operations for {accountId}: inserted {len(ops_out)}, skipped {skipped}")
+    return len(ops_out)
 
 
 def get_tinkoff_positions(accountId: str):
     positions = tinkoff_client.get_positions(accountId)
-    account = models.Account.account_by_id(accountId)
+    store_tinkoff_positions(accountId, positions)
+
 
-    # TODO: temporary workaround for soldout items
-    models.Position.objects.filter(account=account).update(quantity=0)
+def store_tinkoff_positions(accountId: str, positions):
+    """Сверяет полученный из API портфель счета с позициями в базе и записывает только разницу:
+    новые позиции добавляются, изменившиеся - обновляются, а проданные - обнуляются.
+    Все изменения пишутся пачками в одной транзакции.
+    Позиции сопоставляются по instrument_uid: позиция, инструмент которой не найден,
+    сохраняется без него (его проставит backfill_missing_instruments), а не обнуляется.
+    """
+    account = models.Account.account_by_id(accountId)
+    instruments = models.Instrument.get_instruments([position.instrument_uid for position in positions], "uid")
 
+    snapshot = {}
     for tmpPosition in positions:
-        print("------------------------------------")
         try:
-            position = models.position_from_tinkoff_client(tmpPosition, accountId)
+            position = models.position_from_tinkoff_client(tmpPosition, accountId, account, instruments)
         except Exception as e:
             logging.warning(f"Позиция не обработана - пропускаю:\n{tmpPosition} ")
             logging.error(f"Возникшая ошибка:\n{e}")
             continue
-
-        try:
-            position.save()
+        snapshot[(position.instrument_uid, position.blocked)] = position
+
+    current = {(position.instrument_uid, position.blocked): position
+               for position in models.Position.objects.filter(account=account)}
+
+    now = datetime.now(tz=timezone.utc)
+    to_create = []
+    to_update = []
+    for key, position in snapshot.items():
+        existing = current.pop(key, None)
+        if existing is None:
+            to_create.append(position)
             continue
-        except IntegrityError:
-            taskLogger.info(f"Position {position.figi} already exists in {account} - updating")
-
-        # Если уже есть - то обновить
-        tmpPositions = models.Position.objects.filter(
-            instrument=position.instrument,
-            account=account,
-            blocked=position.blocked
-        )
-        if tmpPositions.count() == 1:
-            tmpPosition = tmpPositions[0]
-        else:
-            taskLogger.error(f"More than 1 position for {position.figi} in {account}!")
-            tmpPosition = tmpPositions[0]
+        instrument_found = existing.instrument_id is None and position.instrument is not None
+        if existing.quantity == position.quantity and not instrument_found:
+            continue
+        if instrument_found:
+            existing.instrument = position.instrument
+        existing.quantity = position.quantity
+        existing.figi = position.figi
+        existing.position_uid = position.position_uid
+        existing.instrument_uid = position.instrument_uid
+        existing.updated = now  # bulk_update не обновляет auto_now поля
+        to_update.append(existing)
+
+    # позиций, которых нет в портфеле из API, на счете больше нет
+    for existing in current.values():
+        if existing.quantity == 0:
+            continue
+        existing.quantity = 0
+        existing.updated = now
+        to_update.append(existing)
+
+    with transaction.atomic():
+        models.Position.objects.bulk_create(to_create)
+        models.Position.objects.bulk_update(
+            to_update, ["instrument", "quantity", "figi", "position_uid", "instrument_uid", "updated"])
+    if len(to_create) > 0 or len(to_update) > 0:
+        # bulk-операции не вызывают сигналов - сбрасываем купленные количества сами
+        holdings_aggregator.invalidate_accounts([account.pk])
+    taskLogger.info(f"Positions for {account}: added {len(to_create)}, updated {len(to_update)}")
 
-        position.pk = tmpPosition.pk
-        position.save()
 
 
+def backfill_missing_instruments() -> int:
+    """Проставляет инструменты операциям и позициям, сохраненным без них
+    (например, из-за временной ошибки API при синхронизации) - одним поиском на тип идентификатора.
+
+    Returns:
+        int: количество исправленных записей
+    """
+    operations = list(models.Operation.objects.filter(instrument=None).exclude(figi="").exclude(figi=None))
+    instruments = models.Instrument.get_instruments([operation.figi for operation in operations], "figi")
+    fixed_operations = []
+    for operation in operations:
+        operation.instrument = instruments.get(operation.figi)
+        if operation.instrument is not None:
+            fixed_operations.append(operation)
+    models.Operation.objects.bulk_update(fixed_operations, ["instrument"], batch_size=OPERATIONS_BATCH_SIZE)
+
+    positions = list(models.Position.objects.filter(instrument=None).exclude(instrument_uid=""))
+    instruments = models.Instrument.get_instruments([position.instrument_uid for position in positions], "uid")
+    fixed_positions = []
+    for position in positions:
+        position.instrument = instruments.get(position.instrument_uid)
+        if position.instrument is not None:
+            fixed_positions.append(position)
+    models.Position.objects.bulk_update(fixed_positions, ["instrument"])
+    if len(fixed_positions) > 0:
+        # bulk-операции не вызывают сигналов - сбрасываем купленные количества сами
+        holdings_aggregator.invalidate_accounts(set(position.account_id for position in fixed_positions))
+
+    taskLogger.info(f"Instruments backfilled: {len(fixed_operations)} of {len(operations)} operations, "
+                    f"{len(fixed_positions)} of {len(positions)} positions")
+    return len(fixed_operations) + len(fixed_positions)
+
 def preload_currencies_to_db():
     """Загружает список валют с Центробанка, дополняя необходимые данные в базу данных
     """
@@ -258,13 +674,38 @@ def preload_currencies_to_db():
             currency.save()
 
 
-def preload_splits_list_to_db():
-    splits = moex_client.get_splits_list_from_moex()
+def preload_splits_list_to_db() -> int:
+    """Догружает сплиты с даты последнего сохраненного (с запасом SPLITS_LOOKBACK_DAYS)
+    и записывает новые одной пачкой.
+    Ошибка запроса к МосБирже пробрасывается - неполный список не записывается.
 
+    Returns:
+        int: количество полученных новых сплитов
+    """
+    last_date = models.Split.objects.aggregate(Max("date"))["date__max"]
+    since = None
+    if last_date is not None:
+        # ISS может опубликовать сплит задним числом или в тот же день, а объявленные заранее
+        # сплиты имеют будущую дату - поэтому перечитываем окно до последней даты и сегодняшнего дня
+        since = min(last_date, date.today()) - timedelta(days=settings.SPLITS_LOOKBACK_DAYS)
+    splits = list(moex_client.get_splits_list_from_moex(since))
+
+    existing = set()
+    if since is not None:
+        existing = set(models.Split.objects.filter(date__gte=since).values_list("date", "ticker"))
+    new_splits = {}
     for split in splits:
-        models.Split.objects.get_or_create(
-            date=split["tradedate"], ticker=split['secid'],
-            defaults={"before": split["before"], "after": split["after"]})
+        split_date = date.fromisoformat(split["tradedate"])
+        if (split_date, split["secid"]) in existing:
+            continue
+        new_splits[(split_date, split["secid"])] = models.Split(
+            date=split_date, ticker=split["secid"], before=split["before"], after=split["after"])
+    if len(new_splits) > 0:
+        # bulk_create не вызывает сигналы, поэтому множители сплитов сбрасываем сами
+        models.Split.objects.bulk_create(new_splits.values(), ignore_conflicts=True)
+        split_adjuster.invalidate()
+    taskLogger.info(f"Got {len(new_splits)} new splits since {since}")
+    return len(new_splits)
 
 
 def process_sberbank_report_upload(f) -> tuple[str, bool]:
@@ -300,54 +741,82 @@ def target_portfolio_preload_last_prices(targetPortfolioId: int, use_cache=True)
     cache.set(cache_key, True, 30)
 
 
+def target_portfolio_values_version_key(targetPortfolioId: int) -> str:
+    """Имя версии строк целевого портфеля - увеличивается при любом изменении строк"""
+    return f"target_values_version_{targetPortfolioId}"
+
+
+LAST_PRICES_VERSION_KEY = "last_prices_version"  # версия текущих цен - увеличивается при их обновлении
+
+
 def target_portfolio_total_weight(targetPortfolioId: int, use_cache=True):
     """Расчет общего веса позиций в портфолио.
     Учитывает вес в индексе, помноженный на коэффициент.
     Если в индексе 0 - берет коэффициент как нужный вес.
+    Считается одним агрегатом в базе и кэшируется до изменения строк портфеля
+    (но не дольше TARGET_PORTFOLIO_CACHE_TIMEOUT - изменения из других процессов).
 
     Args:
         targetPortfolioId (int): pk портфолио
         use_cache (bool, optional): Использовать ли кэширования при пересчетах.
 
     Returns:
-        _type_: _description_
+        Decimal: сумма скорректированных весов
     """
-    cache_key = f"total_weight_for_portfolio_{targetPortfolioId}"
+    version, = get_cache_versions(target_portfolio_values_version_key(targetPortfolioId))
+    cache_key = f"total_weight_for_portfolio_{targetPortfolioId}_{version}"
     cached_value = cache.get(cache_key)
     if use_cache and cached_value is not None:
         taskLogger.debug("Used cache for total_weight")
         return cached_value
-    portfolioValues = models.TargetPortfolioValues.objects.filter(targetPortfolio__pk=targetPortfolioId)
-    total_weight = 0
-    for portfolioValue in portfolioValues:
-        if portfolioValue.indexTarget == 0:
-            total_weight += portfolioValue.coefficient
-        else:
-            weight = portfolioValue.indexTarget * portfolioValue.coefficient
-            total_weight += weight
-    cache.set(cache_key, total_weight, 5)
+    total_weight = models.TargetPortfolioValues.objects.filter(
+        targetPortfolio__pk=targetPortfolioId
+        ).aggregate(total_weight=Sum(
+            Case(
+                When(indexTarget=0, then=F("coefficient")),
+                default=F("indexTarget") * F("coefficient"),
+            ),
+            output_field=DecimalField(max_digits=20, decimal_places=9),
+        ))["total_weight"] or Decimal(0)
+    cache.set(cache_key, total_weight, settings.TARGET_PORTFOLIO_CACHE_TIMEOUT)
     return total_weight
 
 
 def target_portfolio_total_value(targetPortfolioId: int, use_cache=True):
-    """Расчет общей стоимости позиций в портфолио.
+    """Расчет общей стоимости позиций в портфолио по текущим ценам из базы.
+    Считается одним запросом: купленные количества и цены подставляются подзапросами.
+    Кэшируется до изменения строк портфеля, позиций его счетов или текущих цен
+    (но не дольше TARGET_PORTFOLIO_CACHE_TIMEOUT - изменения из других процессов).
 
     Args:
         targetPortfolioId (int): pk портфолио
         use_cache (bool, optional): Использовать ли кэширования при пересчетах.
 
     Returns:
-        _type_: _description_
+        Decimal: стоимость купленных бумаг
     """
-    cache_key = f"total_value_for_portfolio_{targetPortfolioId}"
+    versions = get_cache_versions(target_portfolio_values_version_key(targetPortfolioId),
+                                  holdings_aggregator.version_key(targetPortfolioId),
+                                  LAST_PRICES_VERSION_KEY)
+    cache_key = f"total_value_for_portfolio_{targetPortfolioId}_" + "_".join(str(v) for v in versions)
     cached_value = cache.get(cache_key)
     if use_cache and cached_value is not None:
         return cached_value
-    portfolioValues = models.TargetPortfolioValues.objects.filter(targetPortfolio__pk=targetPortfolioId)
-    total_value = 0
-    for portfolioValue in portfolioValues:
-        total_value += portfolioValue.bought_price()
-    cache.set(cache_key, total_value, 10)
+
+    held = models.Position.objects.filter(
+        account__targetportfolio__pk=targetPortfolioId,
+        instrument=OuterRef("instrument"),
+        ).values("instrument").annotate(quantity_sum=Sum("quantity")).values("quantity_sum")
+    price = models.LastPrice.objects.filter(figi=OuterRef("instrument__figi")).values("price")[:1]
+    total_value = models.TargetPortfolioValues.objects.filter(
+        targetPortfolio__pk=targetPortfolioId
+        ).annotate(
+            value=ExpressionWrapper(
+                Coalesce(Subquery(held), 0) * Coalesce(Subquery(price), Decimal(0)),
+                output_field=DecimalField(max_digits=30, decimal_places=9),
+            )
+        ).aggregate(total_value=Sum("value"))["total_value"] or Decimal(0)
+    cache.set(cache_key, total_value, settings.TARGET_PORTFOLIO_CACHE_TIMEOUT)
     return total_value
 
 
@@ -363,18 +832,17 @@ def target_portfolio_to_buy_simple(target_portfolio_pk: int, cash_sum: int):
         _type_: _description_
     """
 
-    targetPositions = models.TargetPortfolioValues.objects.filter(
-        targetPortfolio__pk=target_portfolio_pk
-        ).select_related(
-            "targetPortfolio"
-        ).prefetch_related("instrument").order_by("order_number")
+    target_portfolio = models.TargetPortfolio.objects.get(pk=target_portfolio_pk)
+    snapshot = models.TargetPortfolioSnapshot(target_portfolio)
 
     out = []
-    for item in targetPositions:
-        if item.my_weight() == Decimal(0):
+    for item in snapshot.positions:
+        if item.calc.my_weight == Decimal(0):
             continue
         lot = item.instrument.lot
-        price = item.current_price()
+        price = item.calc.current_price
+        if price == 0:
+            continue
         lot_price = lot*price
         if lot_price < cash_sum:
             qtty_lot = int(cash_sum/lot_price)
@@ -387,11 +855,134 @@ def target_portfolio_to_buy_simple(target_portfolio_pk: int, cash_sum: int):
     return out
 
 
+def target_portfolio_to_buy_optimal(target_portfolio_pk: int, cash_sum: int):
+    """Расчет, что купить в портфель на сумму с балансировкой по весам.
+    Сумма распределяется по позициям так, чтобы стоимость каждой после покупки
+    была как можно ближе к ее доле my_weight от портфеля (купленное + сумма),
+    покупаются только целые лоты, уже купленные бумаги учитываются.
+
+    Сначала каждой позиции отдается целое число лотов в пределах ее недобора
+    (если недоборов больше суммы - пропорционально уменьшенных), затем остаток
+    раздается по одному лоту позициям с наибольшим недобором через очередь с приоритетом,
+    пока покупка лота уменьшает отклонение позиции от цели.
+
+    Args:
+        target_portfolio_pk (int): pk портфолио для расчета
+        cash_sum (int): сумма для расчета покупок
+
+    Returns:
+        list[dict]: позиции с количеством лотов и бумаг к покупке - как в target_portfolio_to_buy_simple
+    """
+    target_portfolio = models.TargetPortfolio.objects.get(pk=target_portfolio_pk)
+    snapshot = models.TargetPortfolioSnapshot(target_portfolio)
+    cash = Decimal(cash_sum)
+    total = snapshot.total_value + cash
+
+    items = []  # [позиция, цена лота, недобор до цели, лотов к покупке]
+    for position in snapshot.positions:
+        lot_price = position.instrument.lot * position.calc.current_price
+        if position.calc.my_weight == 0 or lot_price <= 0:
+            continue
+        deficit = total * position.calc.my_weight / 100 - position.calc.bought_price
+        items.append([position, lot_price, deficit, 0])
+
+    # целые лоты в пределах недобора
+    total_deficit = sum(item[2] for item in items if item[2] > 0)
+    scale = min(Decimal(1), cash / total_deficit) if total_deficit > 0 else Decimal(0)
+    for item in items:
+        if item[2] <= 0:
+            continue
+        lots = int(item[2] * scale // item[1])
+        item[3] = lots
+        item[2] -= lots * item[1]
+        cash -= lots * item[1]
+
+    # остаток - по лоту туда, где недобор больше всего
+    heap = [(-item[2], i) for i, item in enumerate(items) if item[2] * 2 > item[1]]
+    heapq.heapify(heap)
+    while heap and cash > 0:
+        _, i = heapq.heappop(heap)
+        item = items[i]
+        if item[1] > cash:
+            continue  # лот не по карману - позиция выбывает
+        item[3] += 1
+        item[2] -= item[1]
+        cash -= item[1]
+        # лот имеет смысл, только пока он уменьшает отклонение от цели
+        if item[2] * 2 > item[1]:
+            heapq.heappush(heap, (-item[2], i))
+
+    out = []
+    for position, _, _, lots in items:
+        if lots == 0:
+            continue
+        out.append({
+            "position": position,
+            "qtty_lot": lots,
+            "qtty_items": lots * position.instrument.lot,
+        })
+    return out
+
+
+async def sync_tinkoff_accounts(accounts: "list[tuple[models.Account, datetime]]",
+                                concurrency: int = settings.TINKOFF_SYNC_CONCURRENCY) -> dict[str, int]:
+    """Параллельно запрашивает операции и портфели счетов Т-Банка.
+    Запросы к API идут одновременно (не больше concurrency счетов за раз),
+    а запись в базу идет через единственного писателя, чтобы не блокировать SQLite.
+
+    Args:
+        accounts (list[tuple[Account, datetime]]): счета и даты, с которых запрашивать операции
+        concurrency (int, optional): сколько счетов запрашивать одновременно
+
+    Returns:
+        dict[str, int]: количество добавленных операций по accountId
+    """
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(_tinkoff_accounts_writer(queue))
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async with tclient.tinkoff_async_client(settings.TINKOFF_API_KEY) as client:
+        async def fetch_account(account: "models.Account", start_date: datetime):
+            taskLogger.info(f"Starting parsing of account {account.name} ({account.accountId})")
+            async with semaphore:
+                try:
+                    operations = await client.get_operations(account.accountId, start_date)
+                    positions = await client.get_positions(account.accountId)
+                except Exception as e:
+                    taskLogger.error(f"Cannot load account {account.name} ({account.accountId}): {e}")
+                    return
+            await queue.put((account, operations, positions))
+
+        await asyncio.gather(*(fetch_account(account, start_date) for account, start_date in accounts))
+
+    await queue.put(None)
+    return await writer
+
+
+async def _tinkoff_accounts_writer(queue: asyncio.Queue) -> dict[str, int]:
+    """Единственный писатель в базу для sync_tinkoff_accounts.
+    sync_to_async по умолчанию выполняет все вызовы в одном потоке, поэтому записи не пересекаются.
+    """
+    op_counts = {}
+    while (item := await queue.get()) is not None:
+        account, operations, positions = item
+        op_count = await sync_to_async(store_tinkoff_operations)(account.accountId, operations)
+        if op_count > 0:
+            taskLogger.info(f"Loading positions for {account.name}")
+            await sync_to_async(store_tinkoff_positions)(account.accountId, positions)
+        op_counts[account.accountId] = op_count
+    return op_counts
+
+
 def update_all_accounts():
     """Запрашивает информацию по последним сделкам всех счетов, обновляет портфолио
     """
     taskLogger.info("Splits list update")
-    preload_splits_list_to_db()
+    try:
+        preload_splits_list_to_db()
+    except Exception as e:
+        # без свежих сплитов счета все равно обновляем - сплиты догрузятся при следующем запуске
+        taskLogger.error(f"Splits list was not updated: {e}")
 
     taskLogger.info("Updating tinkoff accounts list")
     update_tinkoff_accounts()
@@ -401,20 +992,26 @@ def update_all_accounts():
     first_new_op_date = datetime.now(tz=timezone.utc)
     tinkoff_bank = models.Bank.get_tinkoff()
     print(tinkoff_bank)
+    accounts_to_sync = []
     for account in accounts:
         if account.bankId != tinkoff_bank:
             # парсим здесь только счета Т-Банк, остальные - пропускаем
             continue
 
-        taskLogger.info(f"Starting parsing of account {account.name} ({account.accountId})")
         last_op = models.Operation.objects.filter(account=account).order_by("-timestamp").first()
         if last_op is not None:
             last_op_date = last_op.timestamp
         else:
             last_op_date = datetime.fromtimestamp(0, tz=timezone.utc)
         taskLogger.info(f"Last operation date for {account.name} - {last_op_date}")
-        op_count = get_tinkoff_operations(accountId=account.accountId, startDate=last_op_date)
-        taskLogger.info(f"Loaded {op_count} operations")
+        accounts_to_sync.append((account, last_op_date))
+
+    # запросы ко всем счетам идут параллельно, запись в базу - последовательно
+    op_counts = asyncio.run(sync_tinkoff_accounts(accounts_to_sync))
+
+    for account, last_op_date in accounts_to_sync:
+        op_count = op_counts.get(account.accountId, 0)
+        taskLogger.info(f"Loaded {op_count} operations for {account.name} ({account.accountId})")
         if op_count > 0:
             new_operations = models.Operation.objects.filter(
                 account=account, timestamp__gte=last_op_date).order_by("timestamp")
@@ -423,45 +1020,102 @@ def update_all_accounts():
             if new_operations[0].timestamp < first_new_op_date:
                 # дата для загрузки динамики курса валют
                 first_new_op_date = new_operations[0].timestamp
-
-            taskLogger.info(f"Loading positions for {account.name}")
-            get_tinkoff_positions(accountId=account.accountId)
         total_ops += op_count
+
+    taskLogger.info("Backfilling instruments of operations and positions stored without them")
+    backfill_missing_instruments()
+
     if total_ops > 0:
         taskLogger.info("Preloasding CBRF rates for new operations")
-        currencies = models.Currency.objects.filter(auto_rate_preload=True)
-        for currency in currencies:
-            c = get_cb_rate_dynamics(currency.code, first_new_op_date)
-            taskLogger.info(f"Added {c} rates for '{currency.code}'")
+        currencies = list(models.Currency.objects.filter(auto_rate_preload=True).values_list("code", flat=True))
+        c = load_cb_rates(currencies, first_new_op_date)
+        taskLogger.info(f"Added {c} rates for {currencies}")
     taskLogger.info(f"Total operations parsed: {total_ops}")
+    taskLogger.debug(f"Tinkoff API channels opened: {tinkoff_client.channel_opens}")
     return total_ops
 
 
+def get_index_composition(index_code: str) -> "dict[str, Decimal]":
+    """Возвращает последний сохраненный состав индекса.
+    Раз в INDEX_COMPOSITION_TIMEOUT состав перепроверяется на МосБирже и сохраняется в историю.
+
+    Args:
+        index_code (str): код индекса, например IMOEX
+
+    Returns:
+        dict[str, Decimal]: вес в индексе по тикеру
+    """
+    cache_key = f"index_composition_checked_{index_code}"
+    if cache.get(cache_key) is None:
+        index_positions = moex_client.get_index_positions(index_code, date=datetime.now())
+        if len(index_positions) > 0:
+            store_index_composition(index_code, index_positions)
+            cache.set(cache_key, True, settings.INDEX_COMPOSITION_TIMEOUT)
+
+    compositions = models.IndexComposition.objects.filter(index_code=index_code)
+    last_date = compositions.aggregate(Max("date"))["date__max"]
+    if last_date is None:
+        return {}
+    return dict(compositions.filter(date=last_date).order_by("-weight").values_list("ticker", "weight"))
+
+
+def store_index_composition(index_code: str, index_positions: list[dict]) -> int:
+    """Сохраняет состав индекса из ответа МосБиржи. Уже сохраненные даты пропускаются.
+
+    Returns:
+        int: количество переданных позиций
+    """
+    compositions = [
+        models.IndexComposition(index_code=index_code, date=position["tradedate"],
+                                ticker=position["ticker"], weight=Decimal(position["weight"]))
+        for position in index_positions
+    ]
+    models.IndexComposition.objects.bulk_create(compositions, ignore_conflicts=True)
+    return len(compositions)
+
+
 def update_index_positions_in_target(targetPortfolio_pk: int, index_code: str = "IMOEX"):
-    index_positions = moex_client.get_index_positions(index_code)
-    # установить в 0 все позиции
+    """Проставляет веса индекса в целевой портфель.
+    Меняются только строки, у которых вес изменился, новые бумаги индекса добавляются в конец списка.
+    """
     targetPortfolio = models.TargetPortfolio.objects.get(pk=targetPortfolio_pk)
-    models.TargetPortfolioValues.objects.filter(targetPortfolio=targetPortfolio).update(indexTarget=0)
-    # устанавливаем счетчик в количество детей - чтобы добавлять строки внизу списка
-    new_item_order_number = targetPortfolio.positions_count() + 1
-    # пройти по списку позиций индекса и проставить нужные/добавить новые элементы
-    for indexPos in index_positions:
-        ticker = indexPos['ticker']
-        weight = Decimal(indexPos['weight'])
-        taskLogger.info(f"Put weight of {weight} for {ticker}")
-        class_code = "TQBR"  # запрос пока только с мосбиржи - поэтому этот класс
-        instrument = models.Instrument.get_instrument_by_ticker(ticker, class_code)
-        _, created = models.TargetPortfolioValues.objects.update_or_create(
-            targetPortfolio=targetPortfolio,
-            instrument=instrument,
-            defaults={"indexTarget": weight},
-            create_defaults={"targetPortfolio": targetPortfolio,
-                             "order_number": new_item_order_number,
-                             "instrument": instrument,
-                             "indexTarget": weight}
-        )
-        if created:
-            taskLogger.info(f"Ticker {ticker} was added at position {new_item_order_number}")
-            new_item_order_number += 1
-        pass
-    pass
+    composition = get_index_composition(index_code)
+    if len(composition) == 0:
+        taskLogger.error(f"Composition of index {index_code} is empty - target not updated")
+        return
+
+    class_code = "TQBR"  # запрос пока только с мосбиржи - поэтому этот класс
+    instruments = models.Instrument.get_instruments([f"{ticker}:{class_code}" for ticker in composition], "ticker")
+    weights = {}
+    for ticker, weight in composition.items():
+        instrument = instruments.get(f"{ticker}:{class_code}")
+        if instrument is None:
+            taskLogger.error(f"Cannot find instrument for {ticker} from index {index_code} - skipping")
+            continue
+        weights[instrument.pk] = weight
+
+    # позиции, которых больше нет в индексе, получают вес 0
+    to_update = []
+    values = models.TargetPortfolioValues.objects.filter(targetPortfolio=targetPortfolio).only(
+        "pk", "instrument_id", "indexTarget")
+    for value in values:
+        weight = weights.pop(value.instrument_id, Decimal(0))
+        if value.indexTarget != weight:
+            value.indexTarget = weight
+            to_update.append(value)
+    models.TargetPortfolioValues.objects.bulk_update(to_update, ["indexTarget"])
+
+    # оставшиеся бумаги индекса добавляем внизу списка
+    if len(weights) > 0:
+        new_item_order_number = models.TargetPortfolioValues.objects.next_order_number(targetPortfolio)
+        to_create = []
+        for instrument_pk, weight in weights.items():
+            to_create.append(models.TargetPortfolioValues(targetPortfolio=targetPortfolio, instrument_id=instrument_pk,
+                                                          order_number=new_item_order_number, indexTarget=weight))
+            new_item_order_number += models.TargetPortfolioValues.objects.ORDER_NUMBER_GAP
+        models.TargetPortfolioValues.objects.bulk_create(to_create)
+    if len(to_update) > 0 or len(weights) > 0:
+        # bulk-операции не вызывают сигналов - сбрасываем итоги портфеля сами
+        bump_cache_version(target_portfolio_values_version_key(targetPortfolio.pk))
+    taskLogger.info(f"Index {index_code} in target {targetPortfolio}: "
+                    f"updated {len(to_update)}, added {len(weights)} positions")
@@ -1,19 +1,140 @@
+import atexit
 import logging
+import threading
+import time
 
 from datetime import datetime
+from typing import Callable, TypeVar
+
+import grpc
 from django.conf import settings
-from tinkoff.invest import Client, InstrumentIdType, Account, Instrument, Operation, Share, PortfolioPosition
+from tinkoff.invest import AsyncClient, Client, InstrumentIdType, Account, Instrument, Operation, Share, PortfolioPosition
+from tinkoff.invest import Bond, Currency, Etf
+from tinkoff.invest import RequestError
+from tinkoff.invest.async_services import AsyncServices
+from tinkoff.invest.services import Services
 
 tlogger = logging.getLogger(__name__)
 tlogger.setLevel(settings.API_CALLS_LOGGING_LEVEL)
 
+T = TypeVar("T")
+
+# Коды ошибок, после которых канал считается сломанным и открывается заново
+RECONNECT_STATUS_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.INTERNAL)
+# Коды ошибок, означающие, что инструмента с таким идентификатором нет - повторять запрос бессмысленно
+NOT_FOUND_STATUS_CODES = (grpc.StatusCode.NOT_FOUND, grpc.StatusCode.INVALID_ARGUMENT)
+
+
+def is_not_found_error(error: Exception) -> bool:
+    """Проверяет, что ошибка API означает отсутствие инструмента, а не временный сбой"""
+    return isinstance(error, RequestError) and error.code in NOT_FOUND_STATUS_CODES
+
+
+class _PooledChannel():
+    """Открытый канал к API Т-Банка и сервисы поверх него"""
+
+    def __init__(self, token: str):
+        self.client = Client(token)
+        self.services: Services = self.client.__enter__()
+        self.last_used = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        """Проверяет канал, если им давно не пользовались"""
+        if time.monotonic() - self.last_used < settings.TINKOFF_CHANNEL_MAX_IDLE:
+            return True
+        try:
+            grpc.channel_ready_future(self.client._channel).result(
+                timeout=settings.TINKOFF_CHANNEL_HEALTH_TIMEOUT)
+        except grpc.FutureTimeoutError:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.client.__exit__(None, None, None)
+        except Exception as e:
+            tlogger.warning(f"TClient - error closing channel: {e}")
+
 
 class tinkoff_client():
+    """Клиент API Т-Банка.
+
+    Держит небольшой пул долгоживущих gRPC каналов, которые переиспользуются всеми запросами,
+    вместо открытия нового канала (TLS + авторизация) на каждый вызов.
+    Каналы gRPC потокобезопасны, поэтому пул раздается по кругу.
+    """
 
     TOKEN = ""
 
-    def __init__(self, token):
+    def __init__(self, token, pool_size: int = settings.TINKOFF_CHANNEL_POOL_SIZE):
         self.TOKEN = token
+        self.pool_size = max(1, pool_size)
+        self.channel_opens = 0  # сколько раз открывались каналы - для отладки и замеров
+        self._pool: list[_PooledChannel | None] = [None] * self.pool_size
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _acquire(self) -> tuple[int, Services]:
+        """Возвращает номер слота пула и сервисы открытого канала, при необходимости (пере)открывая его.
+        Под блокировкой только выбирается и подменяется канал слота: проверка канала (до
+        TINKOFF_CHANNEL_HEALTH_TIMEOUT) и открытие нового идут без нее, чтобы не задерживать
+        запросы других потоков.
+        """
+        with self._lock:
+            slot = self._next_slot
+            self._next_slot = (self._next_slot + 1) % self.pool_size
+            channel = self._pool[slot]
+
+        if channel is not None and not channel.is_healthy():
+            tlogger.warning(f"TClient - channel {slot} failed health check - reconnecting")
+            with self._lock:
+                if self._pool[slot] is channel:
+                    self._pool[slot] = None
+            channel.close()
+            channel = None
+
+        if channel is None:
+            tlogger.debug(f"TClient - opening channel {slot}")
+            new_channel = _PooledChannel(self.TOKEN)
+            with self._lock:
+                channel = self._pool[slot]
+                if channel is None:
+                    channel = self._pool[slot] = new_channel
+                    self.channel_opens += 1
+            if channel is not new_channel:
+                # слот уже заполнил другой поток - пользуемся его каналом
+                new_channel.close()
+
+        channel.last_used = time.monotonic()
+        return slot, channel.services
+
+    def _reset(self, slot: int):
+        with self._lock:
+            channel = self._pool[slot]
+            self._pool[slot] = None
+        if channel is not None:
+            channel.close()
+
+    def _call(self, request: Callable[[Services], T]) -> T:
+        """Выполняет запрос на канале из пула.
+        Если канал оказался сломан - переоткрывает его и повторяет запрос один раз.
+        """
+        slot, services = self._acquire()
+        try:
+            return request(services)
+        except RequestError as e:
+            if e.code not in RECONNECT_STATUS_CODES:
+                raise
+            tlogger.warning(f"TClient - request failed with {e.code.name} - reconnecting")
+            self._reset(slot)
+        slot, services = self._acquire()
+        return request(services)
+
+    def close(self):
+        """Закрывает все открытые каналы пула"""
+        for slot in range(self.pool_size):
+            self._reset(slot)
 
     def get_accounts(self) -> list[Account]:
         """Запрашивает список счетов из Т-Банка
@@ -22,8 +143,7 @@ class tinkoff_client():
             List: Account models
         """
         tlogger.info("Getting list of accounts from Tinkoff")
-        with Client(self.TOKEN) as client:
-            accounts_in = client.users.get_accounts().accounts
+        accounts_in = self._call(lambda client: client.users.get_accounts().accounts)
         return accounts_in
 
     def get_instrument_by_figi(self, figi: str) -> Instrument:
@@ -36,8 +156,8 @@ class tinkoff_client():
             Instrument: _description_
         """
         tlogger.info(f"TClient - get instrument {figi}")
-        with Client(self.TOKEN) as client:
-            result = client.instruments.get_instrument_by(id=figi, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI)
+        result = self._call(lambda client: client.instruments.get_instrument_by(
+            id=figi, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI))
 
         return result.instrument
 
@@ -52,10 +172,8 @@ class tinkoff_client():
             Instrument: data
         """
         tlogger.info(f"TClient - get instrument {ticker}")
-        with Client(self.TOKEN) as client:
-            result = client.instruments.get_instrument_by(id=ticker,
-                                                          id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER,
-                                                          class_code=class_code)
+        result = self._call(lambda client: client.instruments.get_instrument_by(
+            id=ticker, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_TICKER, class_code=class_code))
         return result.instrument
 
     def get_instrument_by_uid(self, uid: str) -> Instrument:
@@ -68,14 +186,13 @@ class tinkoff_client():
             Instrument: _description_
         """
         tlogger.info(f"TClient - get instrument {uid}")
-        with Client(self.TOKEN) as client:
-            result = client.instruments.get_instrument_by(id=uid, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID)
+        result = self._call(lambda client: client.instruments.get_instrument_by(
+            id=uid, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_UID))
         return result.instrument
 
     def get_lastprice(self, figi: list[str]):
         tlogger.info(f"TClient - get last price for {figi}")
-        with Client(self.TOKEN) as client:
-            result = client.market_data.get_last_prices(instrument_id=figi)
+        result = self._call(lambda client: client.market_data.get_last_prices(instrument_id=figi))
         return result.last_prices
 
     def get_operations(self, accountId: str,
@@ -83,20 +200,75 @@ class tinkoff_client():
                        endDate: datetime | None = None,
                        figi: str = "") -> list[Operation]:
         tlogger.info(f"TClient - get operations list for account {accountId}")
-        with Client(self.TOKEN) as client:
-            operations = client.operations.get_operations(
-                account_id=accountId, from_=startDate, to=endDate, figi=figi).operations
+        operations = self._call(lambda client: client.operations.get_operations(
+            account_id=accountId, from_=startDate, to=endDate, figi=figi).operations)
         return operations
 
     def get_positions(self, accountId: str) -> list[PortfolioPosition]:
         tlogger.info(f"TClient - get positions for account {accountId}")
-        with Client(self.TOKEN) as client:
-            positions = client.operations.get_portfolio(
-                account_id=accountId).positions
+        positions = self._call(lambda client: client.operations.get_portfolio(account_id=accountId).positions)
         return positions
 
     def get_share(self, figi: str) -> Share:
         tlogger.info(f"TClient - get share data for {figi}")
-        with Client(self.TOKEN) as client:
-            result = client.instruments.share_by(id=figi, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI)
+        result = self._call(lambda client: client.instruments.share_by(
+            id=figi, id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI))
         return result.instrument
+
+    def get_shares(self) -> list[Share]:
+        tlogger.info("TClient - get shares list")
+        return self._call(lambda client: client.instruments.shares().instruments)
+
+    def get_bonds(self) -> list[Bond]:
+        tlogger.info("TClient - get bonds list")
+        return self._call(lambda client: client.instruments.bonds().instruments)
+
+    def get_etfs(self) -> list[Etf]:
+        tlogger.info("TClient - get etfs list")
+        return self._call(lambda client: client.instruments.etfs().instruments)
+
+    def get_currencies(self) -> list[Currency]:
+        tlogger.info("TClient - get currencies list")
+        return self._call(lambda client: client.instruments.currencies().instruments)
+
+
+class tinkoff_async_client():
+    """Асинхронный клиент API Т-Банка поверх AsyncClient.
+
+    Используется как асинхронный контекстный менеджер - один канал на всю сессию,
+    по которому параллельно идут все запросы:
+
+        async with tinkoff_async_client(token) as client:
+            operations = await client.get_operations(accountId)
+    """
+
+    TOKEN = ""
+
+    def __init__(self, token):
+        self.TOKEN = token
+        self._client: AsyncClient | None = None
+        self._services: AsyncServices | None = None
+
+    async def __aenter__(self) -> "tinkoff_async_client":
+        self._client = AsyncClient(self.TOKEN)
+        self._services = await self._client.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._client.__aexit__(exc_type, exc_val, exc_tb)
+        self._client = None
+        self._services = None
+
+    async def get_operations(self, accountId: str,
+                             startDate: datetime | None = None,
+                             endDate: datetime | None = None,
+                             figi: str = "") -> list[Operation]:
+        tlogger.info(f"TAsyncClient - get operations list for account {accountId}")
+        response = await self._services.operations.get_operations(
+            account_id=accountId, from_=startDate, to=endDate, figi=figi)
+        return response.operations
+
+    async def get_positions(self, accountId: str) -> list[PortfolioPosition]:
+        tlogger.info(f"TAsyncClient - get positions for account {accountId}")
+        response = await self._services.operations.get_portfolio(account_id=accountId)
+        return response.positions
@@ -43,6 +43,8 @@ urlpatterns = [
          name="positionDelete"),
     path("target/position/move/<int:position_pk>/<str:dir>", views.TargetPortfolioPositionItemMove,
          name="positionMove"),
+    path("target/positions/<int:portfolio_pk>/order", views.TargetPortfolioPositionsOrder,
+         name="positionsOrder"),
 
     path("sberbank/upload/", views.UploadSberbankReport,
          name="sberbankUpload")
@@ -1,3 +1,6 @@
+import time
+
+from django.core.cache import cache
 from django.core.paginator import Paginator
 
 
@@ -15,3 +18,25 @@ def paginate(request, qs, limit=20):
     paginated_qs = Paginator(qs, limit)
     page_no = request.GET.get("page")
     return paginated_qs.get_page(page_no)
+
+
+def get_cache_versions(*names: str) -> list[int]:
+    """Возвращает текущие версии для построения ключей кэша - одним обращением к кэшу.
+    Отсутствующая версия создается: начальное значение берется от текущего времени,
+    чтобы после вытеснения версии из кэша не совпасть со старыми ключами.
+    """
+    versions = cache.get_many(names)
+    for name in names:
+        if name not in versions:
+            cache.add(name, time.time_ns(), None)
+            versions[name] = cache.get(name)
+    return [versions[name] for name in names]
+
+
+def bump_cache_version(*names: str):
+    """Увеличивает версии - все ключи кэша, построенные на старых версиях, перестают читаться"""
+    for name in names:
+        try:
+            cache.incr(name)
+        except ValueError:
+            cache.add(name, time.time_ns(), None)
@@ -5,15 +5,17 @@ from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
 from django.contrib import messages
-from django.http import HttpResponse, HttpResponseRedirect, HttpRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, HttpRequest
 from django.shortcuts import render, redirect
 from django.template import loader
 from django.urls import reverse
 from django.views import generic
+from django.views.decorators.http import require_POST
 
 from .forms import (SberbankReportUploadForm, TargetPortfolioForm,
                     TargetPortfolioIndexSelectionForm, TargetPortfolioAddPositionForm)
-from .models import Account, Instrument, Operation, Position, PortfolioPosition, TargetPortfolio, TargetPortfolioValues
+from .models import (Account, Instrument, Operation, Position, PortfolioPosition, TargetPortfolio,
+                     TargetPortfolioSnapshot, TargetPortfolioValues)
 from .utils import is_htmx, paginate
 from . import tasks
 
@@ -50,24 +52,25 @@ def account_positions_update(request, account_pk: int):
 def dividends_view(request, account_pk=0):
     template = loader.get_template("analyzer/dividends.html")
     op_types = ["OPERATION_TYPE_DIVIDEND", "OPERATION_TYPE_DIVIDEND_TAX", "OPERATION_TYPE_COUPON"]
-    dividend_ops = Operation.objects.filter(type__in=op_types).order_by("-timestamp")
+    dividend_ops = list(Operation.objects.filter(type__in=op_types).order_by("-timestamp"))
+    payments_rub = Operation.objects.convert_many(dividend_ops)
     last_year_salary = 0
     years = {}
     salary_year_start = datetime.now(timezone.utc)-timedelta(days=365)
-    for op in dividend_ops:
+    for op, payment_rub in zip(dividend_ops, payments_rub):
         year = op.timestamp.year.__str__()
         if year not in years:
             years[year] = {"dividend": 0, "coupon": 0, "tax": 0, "count": 0}
         years[year]["count"] += 1
         if op.type == "OPERATION_TYPE_DIVIDEND":
-            years[year]["dividend"] += abs(op.payment_rub())
+            years[year]["dividend"] += abs(payment_rub)
         elif op.type == "OPERATION_TYPE_COUPON":
-            years[year]["coupon"] += abs(op.payment_rub())
+            years[year]["coupon"] += abs(payment_rub)
         elif op.type == "OPERATION_TYPE_DIVIDEND_TAX":
-            years[year]["tax"] += abs(op.payment_rub())
+            years[year]["tax"] += abs(payment_rub)
 
         if op.timestamp > salary_year_start:
-            last_year_salary += op.payment_rub()
+            last_year_salary += payment_rub
     context = {
         "operations":  dividend_ops,
         "years": years,
@@ -80,7 +83,9 @@ def dividends_view(request, account_pk=0):
 def devidends_for_year_list(request, year, account_pk=0):
     template = loader.get_template("analyzer/dividends_year_list.html")
     op_types = ["OPERATION_TYPE_DIVIDEND", "OPERATION_TYPE_DIVIDEND_TAX", "OPERATION_TYPE_COUPON"]
-    dividend_ops = Operation.objects.filter(type__in=op_types, timestamp__year=year).order_by("-timestamp")
+    dividend_ops = list(Operation.objects.filter(type__in=op_types, timestamp__year=year).order_by("-timestamp")
+                        .select_related("instrument"))
+    Operation.objects.convert_many(dividend_ops)
     context = {
         "operations":  dividend_ops,
         "year": year
@@ -109,6 +114,7 @@ def operations_list_old(request):
                           exclude(type__in=tax_operations_name).exclude(type__in=comission_operations_name).
                           all().prefetch_related("instrument"),
                           limit=50)
+    Operation.objects.convert_many(operations)
     context = {
         "operations": operations,
         "has_next": operations.has_next,
@@ -140,6 +146,12 @@ class OperationsByDateView(generic.DayArchiveView):
                     all().prefetch_related("instrument"))
         return queryset
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["operations"] = list(context["operations"])
+        Operation.objects.convert_many(context["operations"])
+        return context
+
 
 class PositionsView(generic.ListView):
     model = Position
@@ -227,6 +239,8 @@ def TargetPortfolioToBuy(request: HttpRequest, portfolio_pk: int = 0,
     out = []
     if calculateMethod == "simple":
         out = tasks.target_portfolio_to_buy_simple(portfolio_pk, cash_sum)
+    elif calculateMethod == "optimal":
+        out = tasks.target_portfolio_to_buy_optimal(portfolio_pk, cash_sum)
 
     context = {
         "portfolio": target_portfolio,
@@ -260,18 +274,12 @@ def TargetPortfolioPositions(request, portfolio_pk):
     template = loader.get_template("analyzer/targets_positions_list.html")
 
     targetPortfolio = TargetPortfolio.objects.get(pk=portfolio_pk)
-    targetPositions = TargetPortfolioValues.objects.filter(
-        targetPortfolio__pk=portfolio_pk
-        ).select_related(
-            "targetPortfolio"
-        ).prefetch_related("instrument").order_by("order_number")
-
-    # запрос текущих цен бумаг одним запросом
-    tasks.target_portfolio_preload_last_prices(portfolio_pk)
+    # все строки и их расчетные колонки - за один проход
+    snapshot = TargetPortfolioSnapshot(targetPortfolio)
 
     context = {
         "portfolio": targetPortfolio,
-        "positions": targetPositions,
+        "positions": snapshot.positions,
         }
 
     return HttpResponse(template.render(context, request))
@@ -288,14 +296,9 @@ def TargetPortfolioPositionItem(request, position_pk: int, toggle_update=False):
     """
     template = loader.get_template("analyzer/targets_position_item.html")
 
-    targetPosition = TargetPortfolioValues.objects.filter(
-        pk=position_pk
-        ).select_related(
-            "targetPortfolio"
-        ).prefetch_related("instrument")[0]
-
-    # запрос текущих цен бумаг одним запросом
-    tasks.target_portfolio_preload_last_prices(targetPosition.targetPortfolio.pk)
+    targetPortfolio = TargetPortfolio.objects.get(targetportfoliovalues__pk=position_pk)
+    # вес строки зависит от всего портфеля, поэтому считаем срез целиком
+    targetPosition = TargetPortfolioSnapshot(targetPortfolio).position(position_pk)
 
     context = {
         "position": targetPosition,
@@ -315,34 +318,40 @@ def TargetPortfolioPositionItemMove(request, position_pk: int, dir: str):
         dir (str): direction of movement (up/down)
 
     Returns:
-        HttpResponse: code 200
+        HttpResponse: code 200 if moved, 204 if the position is already at the edge
     """
     targetPosition = TargetPortfolioValues.objects.get(pk=position_pk)
-    movement = 1
-    if dir == "up":
-        movement = -1
-    targetPosition.order_number += movement
-    if targetPosition.order_number == 0:
-        logging.info("Позиция и так на самом верху - двигать некуда!")
-        return HttpResponse()
-    other_positions = TargetPortfolioValues.objects.filter(
-        targetPortfolio=targetPosition.targetPortfolio,
-        order_number__gte=targetPosition.order_number
-    ).order_by("order_number").all()
-    counter = targetPosition.order_number
-    for item in other_positions:
-        if item.order_number == targetPosition.order_number and dir != "up":
-            item.order_number += -1
-            item.save()
-            continue
-        counter += 1
-        item.order_number = counter
-        item.save()
-    targetPosition.save()
+    if not TargetPortfolioValues.objects.move(targetPosition, dir):
+        logging.info("Позиция и так с краю - двигать некуда!")
+        return HttpResponse(status=204)
     logging.debug(f"Item new order position: {targetPosition.order_number}")
     return HttpResponse()
 
 
+@require_POST
+def TargetPortfolioPositionsOrder(request, portfolio_pk: int):
+    """Сохраняет порядок позиций целевого портфеля целиком
+
+    Args:
+        portfolio_pk (int): pk целевого портфеля
+        POST "position": pk позиций в нужном порядке
+
+    Returns:
+        HttpResponse: code 200, 400 - если передан не pk или позиция из другого портфеля
+    """
+    try:
+        position_pks = [int(pk) for pk in request.POST.getlist("position")]
+    except ValueError:
+        return HttpResponseBadRequest("Некорректный список позиций")
+    portfolio_position_pks = set(TargetPortfolioValues.objects.filter(
+        targetPortfolio__pk=portfolio_pk).values_list("pk", flat=True))
+    if not portfolio_position_pks.issuperset(position_pks):
+        return HttpResponseBadRequest("Позиции не принадлежат портфелю")
+    updated = TargetPortfolioValues.objects.apply_order(portfolio_pk, position_pks)
+    logging.debug(f"Target portfolio {portfolio_pk} reordered: {updated} positions moved")
+    return HttpResponse()
+
+
 def TargetPortfolioPositionAdd(request):
     form = TargetPortfolioAddPositionForm(request.POST or None)
     if form.is_valid():
@@ -356,7 +365,7 @@ def TargetPortfolioPositionAdd(request):
             targetPortfolio=targetPortfolio,
             instrument=instrument,
             defaults={
-                "order_number": targetPortfolio.values_count()+1,
+                "order_number": TargetPortfolioValues.objects.next_order_number(targetPortfolio),
                 "indexTarget": Decimal(0),
             }
         )
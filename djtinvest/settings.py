@@ -172,7 +172,37 @@ PORTFOLIO_LOGGING_LEVEL = logging.DEBUG
 TASKS_LOGGING_LEVEL = logging.INFO
 
 INSTRUMENT_TIMEOUT = 14*24*3600  # 2 weeks
+INSTRUMENT_CACHE_SIZE = 5000  # сколько инструментов держать в памяти процесса
+INSTRUMENT_FETCH_CONCURRENCY = 4  # сколько инструментов одновременно запрашивать из API
+INSTRUMENT_BACKGROUND_REFRESH = True  # отдавать устаревшие инструменты сразу, а обновлять в фоне
+INSTRUMENT_REFRESH_BATCH_SIZE = 50  # максимальный размер пачки фонового обновления
+INSTRUMENT_REFRESH_BATCH_WAIT = 2  # seconds - сколько ждать пополнения пачки
+INSTRUMENT_REFRESH_BULK_THRESHOLD = 10  # с какого размера пачки обновлять через справочник
+INSTRUMENT_NEGATIVE_TIMEOUT = 7*24*3600  # 1 week - сколько не искать в API ненайденные инструменты
 LAST_PRICE_TIMEOUT = 300  # 5 minutes
 PORTFOLIO_TIMEOUT = 600  # 10 minutes
 
+TINKOFF_CHANNEL_POOL_SIZE = 2  # количество одновременно открытых gRPC каналов к API
+TINKOFF_CHANNEL_MAX_IDLE = 300  # 5 minutes - после простоя канал проверяется перед использованием
+TINKOFF_CHANNEL_HEALTH_TIMEOUT = 5  # seconds
+TINKOFF_SYNC_CONCURRENCY = 4  # сколько счетов одновременно запрашивать при синхронизации
+
+CBRF_CACHE_DIR = BASE_DIR / ".cbrf_cache"  # кэш ответов ЦБ РФ на диске, None - отключить
+CBRF_CACHE_TODAY_TIMEOUT = 3600  # 1 hour - курсы на сегодня и позже могут еще измениться
+
+MOEX_CONNECT_TIMEOUT = 5  # seconds
+MOEX_READ_TIMEOUT = 30  # seconds
+MOEX_RETRIES = 3  # сколько раз повторять запрос к ISS при сетевых ошибках и 5xx
+MOEX_RETRY_BACKOFF = 0.5  # seconds - пауза перед повтором, удваивается с каждой попыткой
+MOEX_CACHE_SIZE = 256  # сколько ответов ISS держать для условных запросов (ETag/Last-Modified)
+MOEX_SECURITIES_TIMEOUT = 24*3600  # 1 day - как часто обновлять локальный справочник бумаг МосБиржи
+MOEX_SECURITIES_MARKETS = ["shares", "bonds"]  # рынки ISS, загружаемые в справочник
+MOEX_SECURITIES_RETRY_TIMEOUT = 3600  # 1 hour - не чаще скольки секунд пытаться обновить справочник
+SPLITS_LOOKBACK_DAYS = 30  # на сколько дней до последнего сохраненного сплита перечитывать их список
+INDEX_COMPOSITION_TIMEOUT = 12*3600  # 12 hours - как часто перепроверять состав индекса на МосБирже
+# 5 minutes - сколько хранить купленные количества и итоги целевых портфелей.
+# Сигналы сбрасывают их сразу, но только в своем процессе: кэш по умолчанию (LocMemCache) у каждого
+# процесса свой, и изменения из ночной синхронизации веб-процесс увидит не позже этого срока.
+TARGET_PORTFOLIO_CACHE_TIMEOUT = 300
+
 TINKOFF_API_KEY = "t.LongKeyFromTinkoffAPI"
@@ -13,3 +13,6 @@ python3.11 manage.py loaddata banks.json
 # Подгрузка курсов валют при помощи API за большой период - см analyzer/cbrf_client.py
 python3.11 manage.py shell --command="from analyzer.tasks import preload_currencies_to_db; preload_currencies_to_db();"
 
+echo "Подгружаем справочник инструментов Т-Банка"
+python3.11 manage.py preload_instruments
+